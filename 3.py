@@ -6,27 +6,67 @@ Uses MSAL with ROPC (Resource Owner Password Credentials) flow
 """
 
 import os
+import json
+import time
+import atexit
 import logging
+import logging.handlers
+import queue
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from datetime import datetime
-from typing import List, Dict, Any
+from functools import lru_cache
+from typing import List, Dict, Any, IO, Optional, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from jira import JIRA
-from jinja2 import Template
-import base64
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+import html
 import msal
 import html2text
-from bs4 import BeautifulSoup
 import re
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('email_to_jira.log'),
-        logging.StreamHandler()
-    ]
-)
+from token_cache import TOKEN_CACHE_FILE
+
+# Use orjson for Graph payloads when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# Stream multipart uploads to JIRA when requests_toolbelt is installed
+try:
+    from requests_toolbelt import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
+
+# Keep the MSAL token cache in the OS keyring when it is available
+try:
+    import keyring
+except ImportError:
+    keyring = None
+
+# Configure logging - worker threads only enqueue records, a background
+# listener does the file and console writes
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_handlers = [logging.FileHandler('email_to_jira.log'), logging.StreamHandler()]
+for log_handler in log_handlers:
+    log_handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, format='%(message)s',
+                    handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+logging.getLogger('jira').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # ============================================================================
@@ -39,120 +79,160 @@ CLIENT_ID = os.getenv('CLIENT_ID', 'your-client-id')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET', 'your-client-secret')
 MAILBOX_USER = os.getenv('MAILBOX_USER', 'user@domain.com')
 MAILBOX_PASSWORD = os.getenv('MAILBOX_PASSWORD', 'mailbox-password')
+GRAPH_ENDPOINT = 'https://graph.microsoft.com/v1.0'
+GRAPH_SCOPES = ('https://graph.microsoft.com/.default',)
+USE_APP_ONLY = os.getenv('USE_APP_ONLY', '').lower() in ('1', 'true', 'yes')  # Client credentials only, no ROPC
+KEYRING_SERVICE = 'mbx-j'  # Keyring entry for the token cache, keyed by MAILBOX_USER
 
 # JIRA Configuration
 JIRA_URL = os.getenv('JIRA_URL', 'https://your-company.atlassian.net')
 JIRA_USER = os.getenv('JIRA_USER', 'jira-user@domain.com')
 JIRA_PASSWORD = os.getenv('JIRA_PASSWORD', 'jira-password')
 JIRA_PROJECT_KEY = 'IAM'
+JIRA_WORKERS = int(os.getenv('JIRA_WORKERS', '5'))  # Emails processed in parallel
+JIRA_RATE_LIMIT = float(os.getenv('JIRA_RATE_LIMIT', '10'))  # Max JIRA calls per second
+ATTACHMENT_WORKERS = int(os.getenv('ATTACHMENT_WORKERS', '4'))  # Attachment transfers in parallel
 
 # Processing Configuration
 FOLDER_NAME = '#As_JIRA_Ticket'
 BATCH_SIZE = int(os.getenv('BATCH_SIZE', '10'))  # Max emails per run
+PROCESSED_DB = os.getenv('PROCESSED_DB', 'processed.db')  # Emails already turned into tickets
+FOLDER_CACHE_FILE = os.getenv('FOLDER_CACHE_FILE', '.folder_ids.json')  # Resolved folder IDs
+GRAPH_BATCH_LIMIT = 20  # Max sub-requests per Graph $batch call
+GRAPH_CONCURRENCY = int(os.getenv('GRAPH_CONCURRENCY', '4'))  # Max Graph requests in flight
+ATTACHMENT_CHUNK_SIZE = 64 * 1024  # Attachment download read size
+ATTACHMENT_SELECT = 'id,name,contentType,size'  # Attachment metadata only, no contentBytes
+ATTACHMENT_SPOOL_SIZE = 2 * 1024 * 1024  # Attachments above this spill to disk
+FAST_STRIP_MAX = 4096  # Small HTML bodies without formatting skip the parser
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')  # confirmation.html
+
+
+class PostSafeRetry(Retry):
+    """Retry that only repeats a POST the server turned away
+    
+    Graph can answer a POST (sendMail, $batch) with a 5xx after it has already
+    acted on it, so a POST is only retried on 429/503 carrying Retry-After.
+    """
+    
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == 'POST':
+            return bool(self.total) and has_retry_after and status_code in (429, 503)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# Retry throttled (429) and transient server errors, honoring Retry-After.
+# POST is left out of allowed_methods so a read timeout never resends it.
+HTTP_RETRY = PostSafeRetry(
+    total=6,
+    backoff_factor=1,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset(['GET', 'PATCH', 'DELETE']),
+    respect_retry_after_header=True,
+    raise_on_status=False  # Let raise_for_status report the final response
+)
 
 # ============================================================================
 # EMAIL TEMPLATE
 # ============================================================================
 
-EMAIL_TEMPLATE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <style>
-        body {
-            font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-            line-height: 1.6;
-            color: #333;
-            max-width: 600px;
-            margin: 0 auto;
-            background-color: #f4f4f4;
-        }
-        .container {
-            background-color: white;
-            padding: 30px;
-            margin: 20px;
-            border-radius: 8px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .header {
-            background: linear-gradient(135deg, #0052CC 0%, #0747A6 100%);
-            color: white;
-            padding: 20px;
-            border-radius: 8px 8px 0 0;
-            margin: -30px -30px 20px -30px;
-        }
-        .ticket-box {
-            background-color: #f8f9fa;
-            border-left: 4px solid #0052CC;
-            padding: 15px;
-            margin: 20px 0;
-            border-radius: 4px;
-        }
-        .ticket-id {
-            font-size: 24px;
-            font-weight: bold;
-            color: #0052CC;
-            margin: 10px 0;
-        }
-        .info-box {
-            background-color: #E3FCEF;
-            border: 1px solid #00875A;
-            padding: 15px;
-            border-radius: 4px;
-            margin: 20px 0;
-        }
-        .footer {
-            margin-top: 30px;
-            padding-top: 20px;
-            border-top: 1px solid #ddd;
-            font-size: 12px;
-            color: #666;
-        }
-        a {
-            color: #0052CC;
-            text-decoration: none;
-        }
-        a:hover {
-            text-decoration: underline;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1 style="margin: 0;">✓ Request Confirmed</h1>
-        </div>
-        
-        <p>Dear {{ sender_name }},</p>
-        
-        <p>Thank you for your request. Your email has been successfully converted into a JIRA ticket for tracking and processing.</p>
-        
-        <div class="ticket-box">
-            <div>Your Ticket ID:</div>
-            <div class="ticket-id">{{ ticket_key }}</div>
-            <div style="margin-top: 10px;">
-                <strong>Summary:</strong> {{ ticket_summary }}
-            </div>
-        </div>
-        
-        <div class="info-box">
-            <strong>📌 Important:</strong> Please use the JIRA ticket for all further communication regarding this request. 
-            Do not reply to this email.
-        </div>
-        
-        <p>You can view and update your ticket here:<br>
-        <a href="{{ ticket_url }}" style="font-weight: bold;">{{ ticket_url }}</a></p>
-        
-        <p>Our team will review your request and provide updates in the ticket.</p>
-        
-        <div class="footer">
-            <p>This is an automated message from the IAM Team.<br>
-            Generated on {{ timestamp }}</p>
-        </div>
-    </div>
-</body>
-</html>
-"""
+# Loaded once at import; the compiled template is cached on disk between runs
+# and autoescape keeps sender-controlled subjects and names inert in the HTML reply
+JINJA_ENV = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    bytecode_cache=FileSystemBytecodeCache(),
+    autoescape=True,
+    auto_reload=False
+)
+CONFIRMATION_TEMPLATE = JINJA_ENV.get_template('confirmation.html')
+
+# ============================================================================
+# MARKDOWN TO JIRA PATTERNS
+# ============================================================================
+
+RE_HEADER = re.compile(r'^(#{1,6}) (.+)$', re.MULTILINE)
+# Inline markdown in one scan; alternatives are tried in this order at each position
+RE_INLINE = re.compile(
+    r'```(?P<code_block>(?s:.+?))```'
+    r'|`(?P<code>.+?)`'
+    r'|\*\*(?P<bold>.+?)\*\*'
+    r'|__(?P<bold_underscore>.+?)__'
+    r'|~~(?P<strike>.+?)~~'
+    r'|\[(?P<link_text>.+?)\]\((?P<link_url>.+?)\)'
+    r'|(?<!\*)\*(?!\*)(?P<italic>.+?)(?<!\*)\*(?!\*)'
+)
+INLINE_WRAP = {'bold': '*', 'bold_underscore': '*', 'strike': '-', 'italic': '_'}
+INLINE_MARKERS = ('*', '`', '__', '~~', '[')  # RE_INLINE cannot match without one of these
+RE_ORDERED_ITEM = re.compile(r'^\d+\.\s', re.MULTILINE)
+RE_QUOTE_BLOCK = re.compile(r'(?:^> .*(?:\n|\Z))+', re.MULTILINE)
+RE_QUOTE_PREFIX = re.compile(r'^> ', re.MULTILINE)
+RE_EXCESS_NEWLINES = re.compile(r'\n{3,}')
+
+# HTML fast path for small bodies with no markup worth converting
+RE_RICH_TAG = re.compile(
+    r'<(?:h[1-6]|b|strong|i|em|u|s|strike|del|code|pre|a|img|ul|ol|li|blockquote|table)\b',
+    re.IGNORECASE
+)
+# <head> (title, meta) is dropped like script/style, as html2text does
+RE_NON_CONTENT = re.compile(r'<(head|script|style)\b.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+RE_PARAGRAPH_BREAK = re.compile(r'</?(?:p|div)\b[^>]*>', re.IGNORECASE)
+RE_LINE_BREAK = re.compile(r'<br\b[^>]*>', re.IGNORECASE)
+RE_TAG = re.compile(r'<[^>]+>')
+RE_INLINE_SPACE = re.compile(r'[ \t\r\f\v\xa0]+')
+
+# ============================================================================
+# HTTP SESSION
+# ============================================================================
+
+# One keep-alive connection pool shared by Graph calls and MSAL token requests
+HTTP = requests.Session()
+HTTP.headers.update({'User-Agent': 'mbx-j/1.0'})
+HTTP.mount('https://', HTTPAdapter(pool_maxsize=max(10, JIRA_WORKERS + ATTACHMENT_WORKERS), max_retries=HTTP_RETRY))
+
+
+def _build_msal_app(tenant_id: str, client_id: str, client_secret: str) -> msal.ConfidentialClientApplication:
+    """Build the MSAL app backed by a token cache that is persisted across runs.
+    
+    The cache lives in the OS keyring when one is usable and in TOKEN_CACHE_FILE
+    otherwise, so warm runs get the access token without a round trip to the STS.
+    """
+    cache = msal.SerializableTokenCache()
+    blob = None
+    if keyring is not None:
+        try:
+            blob = keyring.get_password(KEYRING_SERVICE, MAILBOX_USER)
+        except Exception as e:
+            logger.warning(f"Keyring unavailable, using token cache file: {e}")
+    if blob is None and os.path.exists(TOKEN_CACHE_FILE):
+        with open(TOKEN_CACHE_FILE, 'r') as f:
+            blob = f.read()
+    if blob:
+        cache.deserialize(blob)
+    
+    def _save_cache():
+        if not cache.has_state_changed:
+            return
+        blob = cache.serialize()
+        if keyring is not None:
+            try:
+                keyring.set_password(KEYRING_SERVICE, MAILBOX_USER, blob)
+                return
+            except Exception as e:
+                logger.warning(f"Could not store token cache in keyring: {e}")
+        os.makedirs(os.path.dirname(TOKEN_CACHE_FILE) or '.', exist_ok=True)
+        # Cache holds refresh tokens - keep it readable by the owner only
+        fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(blob)
+    
+    atexit.register(_save_cache)
+    
+    return msal.ConfidentialClientApplication(
+        client_id=client_id,
+        client_credential=client_secret,
+        authority=f'https://login.microsoftonline.com/{tenant_id}',
+        token_cache=cache,
+        http_client=HTTP
+    )
 
 
 class GraphAPIClient:
@@ -166,22 +246,42 @@ class GraphAPIClient:
         self.username = username
         self.password = password
         self.access_token = None
-        self.graph_endpoint = 'https://graph.microsoft.com/v1.0'
+        self.token_expires_at = 0.0
+        self.headers = {}
+        self._token_lock = threading.Lock()
+        self.folder_ids = self._load_folder_ids()  # Resolved folder name -> ID, kept across runs
+        self.graph_endpoint = GRAPH_ENDPOINT
+        # Delegated tokens address the signed-in user; app-only tokens need the mailbox named
+        self.mailbox = f'/users/{username}' if USE_APP_ONLY else '/me'
+        
+        # Shared pooled session with retry/backoff for all Graph calls
+        self.session = HTTP
+        # Bound in-flight Graph requests across all worker threads to stay under throttling
+        self.graph_slots = threading.BoundedSemaphore(GRAPH_CONCURRENCY)
         
         # Initialize MSAL Confidential Client Application
-        authority = f'https://login.microsoftonline.com/{tenant_id}'
-        self.app = msal.ConfidentialClientApplication(
-            client_id=client_id,
-            client_credential=client_secret,
-            authority=authority
-        )
+        self.app = _build_msal_app(tenant_id, client_id, client_secret)
     
     def get_access_token(self) -> str:
-        """Obtain access token using ROPC (Resource Owner Password Credentials) flow"""
-        scopes = ['https://graph.microsoft.com/.default']
+        """Obtain access token from the MSAL cache, falling back to ROPC flow
+        
+        With USE_APP_ONLY the client credentials flow is used directly.
+        """
+        scopes = GRAPH_SCOPES
         
         try:
-            # Try ROPC flow
+            if USE_APP_ONLY:
+                return self._acquire_app_token(scopes)
+            
+            # Try cached token / refresh token first
+            accounts = self.app.get_accounts(username=self.username)
+            if accounts:
+                result = self.app.acquire_token_silent(scopes, account=accounts[0])
+                if result and "access_token" in result:
+                    logger.info("Successfully obtained access token from cache")
+                    return self._store_token(result)
+            
+            # Cache miss - try ROPC flow
             result = self.app.acquire_token_by_username_password(
                 username=self.username,
                 password=self.password,
@@ -189,9 +289,8 @@ class GraphAPIClient:
             )
             
             if "access_token" in result:
-                self.access_token = result['access_token']
                 logger.info("Successfully obtained access token via ROPC")
-                return self.access_token
+                return self._store_token(result)
             else:
                 error = result.get("error")
                 error_desc = result.get("error_description")
@@ -199,52 +298,129 @@ class GraphAPIClient:
                 
                 # If ROPC fails, try client credentials as fallback
                 logger.info("Attempting client credentials flow as fallback...")
-                result = self.app.acquire_token_for_client(scopes=scopes)
-                
-                if "access_token" in result:
-                    self.access_token = result['access_token']
-                    logger.info("Successfully obtained access token via client credentials")
-                    return self.access_token
-                else:
-                    raise Exception(f"Authentication failed: {result.get('error_description')}")
+                return self._acquire_app_token(scopes)
                     
         except Exception as e:
             logger.error(f"Failed to obtain access token: {e}")
             raise
     
-    def _get_headers(self) -> Dict[str, str]:
-        """Get authorization headers"""
-        if not self.access_token:
-            self.get_access_token()
-        return {
+    def _acquire_app_token(self, scopes) -> str:
+        """Obtain an app-only token via client credentials (MSAL serves it from cache when valid)"""
+        result = self.app.acquire_token_for_client(scopes=scopes)
+        
+        if "access_token" in result:
+            logger.info("Successfully obtained access token via client credentials")
+            # An app-only token has no /me, so address the mailbox explicitly
+            self.mailbox = f'/users/{self.username}'
+            return self._store_token(result)
+        else:
+            raise Exception(f"Authentication failed: {result.get('error_description')}")
+    
+    def _store_token(self, result: Dict) -> str:
+        """Keep the token from an MSAL result along with when to renew it"""
+        self.access_token = result['access_token']
+        # Renew a minute early so in-flight requests never carry an expired token
+        self.token_expires_at = time.time() + int(result.get('expires_in', 0)) - 60
+        # Graph-only headers, built once per token rather than per request.
+        # They stay off the shared session, which MSAL also uses.
+        self.headers = {
             'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json'
         }
+        return self.access_token
+    
+    def _get_headers(self) -> Dict[str, str]:
+        """Get authorization headers, renewing the token once it is about to expire"""
+        if not self.access_token or time.time() >= self.token_expires_at:
+            with self._token_lock:
+                # Another worker may have renewed it while we waited
+                if not self.access_token or time.time() >= self.token_expires_at:
+                    self.get_access_token()
+        return self.headers
+    
+    @staticmethod
+    def _load_folder_ids() -> Dict[str, str]:
+        """Read folder IDs resolved by earlier runs"""
+        try:
+            with open(FOLDER_CACHE_FILE, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _folder_key(self, folder_name: str) -> str:
+        """Folder cache key - IDs are only valid within one tenant's mailbox"""
+        return f'{self.tenant_id}:{self.username}:{folder_name}'
+    
+    def _remember_folder(self, folder_name: str, folder_id: str):
+        """Cache a resolved folder ID for this and later runs"""
+        self.folder_ids[self._folder_key(folder_name)] = folder_id
+        try:
+            # Write then rename so an interrupted run never leaves a truncated cache
+            tmp_file = f'{FOLDER_CACHE_FILE}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self.folder_ids, f)
+            os.replace(tmp_file, FOLDER_CACHE_FILE)
+        except OSError as e:
+            logger.warning(f"Could not save folder cache: {e}")
     
-    def get_folder_id(self, folder_name: str) -> str:
-        """Get the folder ID for a specific folder name"""
-        # Using 'me' endpoint since we're authenticating as the user
-        url = f'{self.graph_endpoint}/me/mailFolders'
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a Graph request while holding one of the GRAPH_CONCURRENCY slots"""
+        with self.graph_slots:
+            return self.session.request(method, url, headers=self._get_headers(), **kwargs)
+    
+    def get_folder_id(self, folder_name: str, refresh: bool = False) -> str:
+        """Get the folder ID for a specific folder name
+        
+        IDs are cached across runs; pass refresh=True when a cached ID stopped working.
+        """
+        cached_id = self.folder_ids.get(self._folder_key(folder_name))
+        if cached_id and not refresh:
+            return cached_id
+        
+        url = f'{self.graph_endpoint}{self.mailbox}/mailFolders'
+        # Only the fields used below; Graph pages folders by 10 unless $top is set
+        params = {
+            '$top': 100,
+            '$select': 'id,displayName,childFolderCount'
+        }
         
         try:
-            response = requests.get(url, headers=self._get_headers())
+            # A top-level folder is matched server-side in a single request
+            filter_params = {
+                '$filter': "displayName eq '{}'".format(folder_name.replace("'", "''")),
+                '$select': 'id,displayName'
+            }
+            response = self._request('GET', url, params=filter_params)
+            response.raise_for_status()
+            matches = json_loads(response.content)['value']
+            if matches:
+                logger.info(f"Found folder '{folder_name}' with ID: {matches[0]['id']}")
+                self._remember_folder(folder_name, matches[0]['id'])
+                return matches[0]['id']
+            
+            # Otherwise look one level down, probing only folders that have children
+            response = self._request('GET', url, params=params)
             response.raise_for_status()
-            folders = response.json()['value']
+            folders = json_loads(response.content)['value']
             
             # Search in all folders including subfolders
             for folder in folders:
                 if folder['displayName'] == folder_name:
                     logger.info(f"Found folder '{folder_name}' with ID: {folder['id']}")
+                    self._remember_folder(folder_name, folder['id'])
                     return folder['id']
                 
                 # Check child folders
-                child_url = f"{self.graph_endpoint}/me/mailFolders/{folder['id']}/childFolders"
-                child_response = requests.get(child_url, headers=self._get_headers())
+                if not folder.get('childFolderCount'):
+                    continue
+                child_url = f"{self.graph_endpoint}{self.mailbox}/mailFolders/{folder['id']}/childFolders"
+                child_response = self._request('GET', child_url, params=params)
                 if child_response.ok:
-                    child_folders = child_response.json().get('value', [])
+                    child_folders = json_loads(child_response.content).get('value', [])
                     for child in child_folders:
                         if child['displayName'] == folder_name:
                             logger.info(f"Found folder '{folder_name}' with ID: {child['id']}")
+                            self._remember_folder(folder_name, child['id'])
                             return child['id']
             
             logger.error(f"Folder '{folder_name}' not found")
@@ -255,17 +431,17 @@ class GraphAPIClient:
     
     def get_messages_from_folder(self, folder_id: str, limit: int = 10) -> List[Dict]:
         """Retrieve messages from a specific folder"""
-        url = f'{self.graph_endpoint}/me/mailFolders/{folder_id}/messages'
+        url = f'{self.graph_endpoint}{self.mailbox}/mailFolders/{folder_id}/messages'
         params = {
             '$top': limit,
             '$orderby': 'receivedDateTime desc',
-            '$select': 'id,subject,from,body,receivedDateTime,hasAttachments'
+            '$select': 'id,internetMessageId,subject,from,body,receivedDateTime,hasAttachments'
         }
         
         try:
-            response = requests.get(url, headers=self._get_headers(), params=params)
+            response = self._request('GET', url, params=params)
             response.raise_for_status()
-            messages = response.json()['value']
+            messages = json_loads(response.content)['value']
             logger.info(f"Retrieved {len(messages)} messages from folder")
             return messages
         except Exception as e:
@@ -273,24 +449,84 @@ class GraphAPIClient:
             raise
     
     def get_attachments(self, message_id: str) -> List[Dict]:
-        """Get all attachments from a message"""
-        url = f'{self.graph_endpoint}/me/messages/{message_id}/attachments'
+        """Get the attachment metadata of a message"""
+        url = f'{self.graph_endpoint}{self.mailbox}/messages/{message_id}/attachments'
+        params = {'$select': ATTACHMENT_SELECT}
         
         try:
-            response = requests.get(url, headers=self._get_headers())
+            response = self._request('GET', url, params=params)
             response.raise_for_status()
-            attachments = response.json()['value']
+            attachments = json_loads(response.content)['value']
             logger.info(f"Retrieved {len(attachments)} attachments for message {message_id}")
             return attachments
         except Exception as e:
             logger.error(f"Error retrieving attachments: {e}")
             return []
     
-    def send_email(self, to_email: str, subject: str, html_body: str):
-        """Send an email using Microsoft Graph API"""
-        url = f'{self.graph_endpoint}/me/sendMail'
+    def get_attachment_content(self, message_id: str, attachment_id: str) -> IO[bytes]:
+        """Stream the raw bytes of a file attachment into a spooled temporary file"""
+        url = f'{self.graph_endpoint}{self.mailbox}/messages/{message_id}/attachments/{attachment_id}/$value'
+        file_obj = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+        
+        try:
+            # Hold the slot for the whole download, not just until the headers arrive
+            with self.graph_slots, self.session.get(url, headers=self._get_headers(), stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(ATTACHMENT_CHUNK_SIZE):
+                    file_obj.write(chunk)
+            file_obj.seek(0)
+            return file_obj
+        except Exception as e:
+            file_obj.close()
+            logger.error(f"Error downloading attachment {attachment_id}: {e}")
+            raise
+    
+    def batch(self, requests_list: List[Dict]) -> Dict[str, Dict]:
+        """Send requests through the Graph $batch endpoint, returning responses keyed by id
+
+        Each request needs 'id', 'method' and 'url' (relative to the API version)
+        and may carry 'body', 'headers' and 'dependsOn'. Requests are sent in
+        chunks of GRAPH_BATCH_LIMIT, so 'dependsOn' must stay within a chunk.
+        """
+        url = f'{self.graph_endpoint}/$batch'
+        responses = {}
         
-        message = {
+        try:
+            for start in range(0, len(requests_list), GRAPH_BATCH_LIMIT):
+                chunk = requests_list[start:start + GRAPH_BATCH_LIMIT]
+                response = self._request('POST', url, data=json_dumps({'requests': chunk}))
+                response.raise_for_status()
+                for item in json_loads(response.content)['responses']:
+                    responses[item['id']] = item
+            return responses
+        except Exception as e:
+            logger.error(f"Error sending batch request: {e}")
+            raise
+    
+    def get_attachments_batch(self, message_ids: List[str]) -> Dict[str, List[Dict]]:
+        """Get the attachment metadata of several messages with batched requests"""
+        requests_list = [
+            {'id': str(i), 'method': 'GET',
+             'url': f'{self.mailbox}/messages/{message_id}/attachments?$select={ATTACHMENT_SELECT}'}
+            for i, message_id in enumerate(message_ids)
+        ]
+        responses = self.batch(requests_list)
+        
+        attachments = {}
+        for i, message_id in enumerate(message_ids):
+            item = responses.get(str(i), {})
+            if item.get('status') == 200:
+                attachments[message_id] = item['body'].get('value', [])
+                logger.info(f"Retrieved {len(attachments[message_id])} attachments for message {message_id}")
+            else:
+                logger.error(f"Error retrieving attachments for message {message_id}: {item.get('body')}")
+                attachments[message_id] = []
+        return attachments
+    
+    @staticmethod
+    def _mail_payload(to_email: str, subject: str, html_body: str) -> Dict:
+        """Build the sendMail request body"""
+        return {
             'message': {
                 'subject': subject,
                 'body': {
@@ -307,9 +543,14 @@ class GraphAPIClient:
             },
             'saveToSentItems': 'true'
         }
+    
+    def send_email(self, to_email: str, subject: str, html_body: str):
+        """Send an email using Microsoft Graph API"""
+        url = f'{self.graph_endpoint}{self.mailbox}/sendMail'
+        message = self._mail_payload(to_email, subject, html_body)
         
         try:
-            response = requests.post(url, headers=self._get_headers(), json=message)
+            response = self._request('POST', url, data=json_dumps(message))
             response.raise_for_status()
             logger.info(f"Email sent successfully to {to_email}")
         except Exception as e:
@@ -318,36 +559,131 @@ class GraphAPIClient:
     
     def delete_message(self, message_id: str):
         """Delete a message (move to Deleted Items)"""
-        url = f'{self.graph_endpoint}/me/messages/{message_id}'
+        url = f'{self.graph_endpoint}{self.mailbox}/messages/{message_id}'
         
         try:
-            response = requests.delete(url, headers=self._get_headers())
+            response = self._request('DELETE', url)
             response.raise_for_status()
             logger.info(f"Message {message_id} deleted successfully")
         except Exception as e:
             logger.error(f"Error deleting message: {e}")
     
+    def reply_and_delete_batch(self, followups: List[Dict]) -> int:
+        """Send confirmations and delete processed emails with batched requests
+        
+        Each follow-up has 'message_id' and optionally 'reply' holding the
+        send_email arguments. A delete depends on its reply, so an email only
+        leaves the folder once its confirmation went out. Requests throttled
+        with 429 are sent again after their Retry-After delay (twice at most).
+        Returns the number of emails removed.
+        """
+        handled = 0
+        # Two requests per email, keeping each reply/delete pair in one $batch call
+        step = GRAPH_BATCH_LIMIT // 2
+        # Follow-ups still to send, with whether their reply still has to go out
+        pending = [(followup, bool(followup.get('reply'))) for followup in followups]
+        
+        for attempt in range(3):
+            throttled = []
+            delay = 0
+            
+            for start in range(0, len(pending), step):
+                chunk = pending[start:start + step]
+                requests_list = []
+                for i, (followup, send_reply) in enumerate(chunk):
+                    delete = {'id': f'{i}-delete', 'method': 'DELETE',
+                              'url': f"{self.mailbox}/messages/{followup['message_id']}"}
+                    if send_reply:
+                        requests_list.append({
+                            'id': f'{i}-reply',
+                            'method': 'POST',
+                            'url': f'{self.mailbox}/sendMail',
+                            'headers': {'Content-Type': 'application/json'},
+                            'body': self._mail_payload(**followup['reply'])
+                        })
+                        delete['dependsOn'] = [f'{i}-reply']
+                    requests_list.append(delete)
+                
+                try:
+                    responses = self.batch(requests_list)
+                except Exception:
+                    continue
+                
+                for i, (followup, send_reply) in enumerate(chunk):
+                    message_id = followup['message_id']
+                    reply = responses.get(f'{i}-reply')
+                    if reply is not None and reply.get('status') != 202:
+                        if reply.get('status') == 429 and attempt < 2:
+                            # Its delete failed on the dependency, so the pair is sent again
+                            throttled.append((followup, True))
+                            delay = max(delay, int(reply.get('headers', {}).get('Retry-After', 1)))
+                        else:
+                            logger.error(f"Error sending confirmation for message {message_id}: {reply.get('body')}")
+                        continue
+                    delete = responses.get(f'{i}-delete', {})
+                    if delete.get('status') == 204:
+                        handled += 1
+                        logger.info(f"Message {message_id} deleted successfully")
+                    elif delete.get('status') == 429 and attempt < 2:
+                        # The confirmation went out - only the delete is sent again
+                        throttled.append((followup, False))
+                        delay = max(delay, int(delete.get('headers', {}).get('Retry-After', 1)))
+                    else:
+                        logger.error(f"Error deleting message {message_id}: {delete.get('body')}")
+            
+            if not throttled:
+                break
+            logger.info(f"{len(throttled)} follow-ups throttled, retrying in {delay}s")
+            time.sleep(delay)
+            pending = throttled
+        
+        return handled
+    
     def move_message(self, message_id: str, destination_folder_id: str):
         """Move a message to another folder"""
-        url = f'{self.graph_endpoint}/me/messages/{message_id}/move'
+        url = f'{self.graph_endpoint}{self.mailbox}/messages/{message_id}/move'
         
         data = {
             'destinationId': destination_folder_id
         }
         
         try:
-            response = requests.post(url, headers=self._get_headers(), json=data)
+            response = self._request('POST', url, data=json_dumps(data))
             response.raise_for_status()
             logger.info(f"Message {message_id} moved successfully")
         except Exception as e:
             logger.error(f"Error moving message: {e}")
 
 
+class RateLimiter:
+    """Thread-safe token bucket allowing `rate` calls per second"""
+    
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a call is allowed"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 0
+                self.updated = time.monotonic()
+            else:
+                self.tokens -= 1
+
+
 class JiraTicketCreator:
     """Handles JIRA ticket creation and management"""
     
     def __init__(self, jira_url: str, username: str, password: str):
         self.jira = JIRA(server=jira_url, basic_auth=(username, password))
+        self.rate_limiter = RateLimiter(JIRA_RATE_LIMIT)
         logger.info("Connected to JIRA successfully")
     
     def create_ticket(self, summary: str, description: str, project_key: str = 'IAM') -> Any:
@@ -360,41 +696,138 @@ class JiraTicketCreator:
         }
         
         try:
-            issue = self.jira.create_issue(fields=issue_dict)
+            self.rate_limiter.acquire()
+            # Only the key is needed, so skip the follow-up GET of the new issue
+            issue = self.jira.create_issue(fields=issue_dict, prefetch=False)
             logger.info(f"Created JIRA ticket: {issue.key}")
             return issue
         except Exception as e:
             logger.error(f"Error creating JIRA ticket: {e}")
             raise
     
-    def add_attachment(self, issue_key: str, filename: str, file_content: bytes):
-        """Add an attachment to a JIRA ticket"""
+    def add_attachments(self, issue_key: str, files: List[Tuple[str, IO[bytes]]]) -> bool:
+        """Add several attachments to a JIRA ticket in one multipart request, returning whether it worked"""
+        url = f'{self.jira.server_url}/rest/api/2/issue/{issue_key}/attachments'
+        fields = [('file', (filename, file_obj, 'application/octet-stream')) for filename, file_obj in files]
+        # Drop the session's JSON content type so requests sets the multipart one
+        headers = {'Content-Type': None, 'X-Atlassian-Token': 'no-check'}
+        
         try:
-            # Create a file-like object from bytes
-            from io import BytesIO
-            file_obj = BytesIO(file_content)
-            file_obj.name = filename
-            
-            self.jira.add_attachment(issue=issue_key, attachment=file_obj, filename=filename)
-            logger.info(f"Added attachment {filename} to {issue_key}")
+            self.rate_limiter.acquire()
+            # jira-python has no multi-file upload, so post through its authenticated session
+            if MultipartEncoder is not None:
+                # Stream the parts instead of building the whole body in memory
+                body = MultipartEncoder(fields=fields)
+                headers['Content-Type'] = body.content_type
+                response = self.jira._session.post(url, data=body, headers=headers)
+            else:
+                response = self.jira._session.post(url, files=fields, headers=headers)
+            response.raise_for_status()
         except Exception as e:
-            logger.error(f"Error adding attachment {filename}: {e}")
+            logger.error(f"Error adding attachments to {issue_key}: {e}")
+            return False
+        
+        logger.info(f"Added {len(files)} attachments to {issue_key}")
+        return True
+    
+    def attachment_names(self, issue_key: str) -> set:
+        """Filenames already attached to a JIRA ticket"""
+        self.rate_limiter.acquire()
+        issue = self.jira.issue(issue_key, fields='attachment')
+        return {attachment.filename for attachment in issue.fields.attachment}
 
 
+class ProcessedStore:
+    """Local record of emails that already have a JIRA ticket
+    
+    Keyed on the internetMessageId, so an email whose ticket was created in a
+    run that failed before deleting it does not get a second ticket. Emails
+    whose attachments have not all reached the ticket are kept in a separate
+    table until they have.
+    """
+    
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS processed(msg_id TEXT PRIMARY KEY, jira_key TEXT, ts INTEGER)'
+        )
+        self.db.execute('CREATE TABLE IF NOT EXISTS attachments_pending(msg_id TEXT PRIMARY KEY)')
+    
+    def get(self, msg_id: str) -> Optional[str]:
+        """Return the ticket key recorded for an email, if any"""
+        with self.lock:
+            row = self.db.execute('SELECT jira_key FROM processed WHERE msg_id=?', (msg_id,)).fetchone()
+        return row[0] if row else None
+    
+    def add(self, msg_id: str, jira_key: str, attachments_pending: bool = False):
+        """Record the ticket created for an email, optionally with its attachments still to upload"""
+        with self.lock:
+            self.db.execute(
+                'INSERT OR IGNORE INTO processed VALUES(?,?,?)',
+                (msg_id, jira_key, int(time.time()))
+            )
+            if attachments_pending:
+                self.db.execute('INSERT OR IGNORE INTO attachments_pending VALUES(?)', (msg_id,))
+    
+    def attachments_pending(self, msg_id: str) -> bool:
+        """Whether an email's ticket is still missing attachments"""
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM attachments_pending WHERE msg_id=?', (msg_id,)).fetchone()
+        return row is not None
+    
+    def attachments_done(self, msg_id: str):
+        """Note that all of an email's attachments reached its ticket"""
+        with self.lock:
+            self.db.execute('DELETE FROM attachments_pending WHERE msg_id=?', (msg_id,))
+
+
+def inline_markup(match: re.Match) -> str:
+    """Convert one inline markdown span to JIRA markup, recursing into its text"""
+    kind = match.lastgroup
+    if kind == 'code_block':
+        return '{code}' + match.group(kind) + '{code}'
+    if kind == 'code':
+        return '{{' + match.group(kind) + '}}'
+    if kind == 'link_url':
+        return '[' + RE_INLINE.sub(inline_markup, match.group('link_text')) + '|' + match.group(kind) + ']'
+    wrap = INLINE_WRAP[kind]
+    return wrap + RE_INLINE.sub(inline_markup, match.group(kind)) + wrap
+
+
+def quote_block(match: re.Match) -> str:
+    """Wrap a run of markdown quote lines in a JIRA quote macro"""
+    block = match.group(0)
+    newline = '\n' if block.endswith('\n') else ''
+    return '{quote}' + RE_QUOTE_PREFIX.sub('', block.rstrip('\n')) + '{quote}' + newline
+
+
+def fast_strip_html(html_content: str) -> str:
+    """Strip tags with regexes, keeping paragraph and line breaks the way html2text does"""
+    text = RE_NON_CONTENT.sub('', html_content)
+    text = RE_PARAGRAPH_BREAK.sub('\n\n', text)
+    text = RE_LINE_BREAK.sub('\n', text)
+    text = html.unescape(RE_TAG.sub('', text))
+    lines = (RE_INLINE_SPACE.sub(' ', line).strip() for line in text.split('\n'))
+    return RE_EXCESS_NEWLINES.sub('\n\n', '\n'.join(lines)).strip()
+
+
+# Pure function of the body; forwarded blasts and auto-replies repeat bodies verbatim
+@lru_cache(maxsize=64)
 def html_to_jira_markup(html_content: str) -> str:
     """Convert HTML email content to JIRA markup format"""
     if not html_content:
         return ""
     
+    # Nothing to convert - building a parse tree would cost more than the body
+    if len(html_content) < FAST_STRIP_MAX and not RE_RICH_TAG.search(html_content):
+        return fast_strip_html(html_content)
+    
     try:
-        # Parse HTML
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Remove script and style elements
-        for script in soup(["script", "style"]):
-            script.decompose()
-        
-        # Convert to markdown first (easier intermediate step)
+        # Convert to markdown first (easier intermediate step). html2text
+        # parses the document itself and drops head/style/script content,
+        # so no separate parse tree is built
         h = html2text.HTML2Text()
         h.ignore_links = False
         h.ignore_images = False
@@ -405,138 +838,139 @@ def html_to_jira_markup(html_content: str) -> str:
         # Now convert markdown to JIRA markup
         jira_text = markdown_text
         
-        # Headers: # Header -> h1. Header
-        jira_text = re.sub(r'^# (.+)
-
-
-def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
-    
-    try:
-        # Extract email details
-        subject = email_message.get('subject', 'No Subject')
-        sender = email_message['from']['emailAddress']
-        sender_email = sender['address']
-        sender_name = sender.get('name', sender_email)
-        message_id = email_message['id']
-        received_date = email_message.get('receivedDateTime', '')
-        
-        logger.info(f"Processing email from {sender_email}: {subject}")
-        
-        # Extract body and convert to JIRA format
-        body = extract_email_body(email_message)
-        
-        # Prepare description with metadata in JIRA format
-        description = f"""h4. Original Email Information
-*From:* {sender_name} <{sender_email}>
-*Received:* {received_date}
-*Subject:* {subject}
-
-----
-
-{body}
-"""
+        # Each pass is skipped when its trigger text is absent; a substring
+        # check is far cheaper than a regex scan over the whole body
         
-        # Create JIRA ticket
-        jira_issue = jira_client.create_ticket(
-            summary=subject,
-            description=description,
-            project_key=JIRA_PROJECT_KEY
-        )
+        # Headers: # Header -> h1. Header, all levels in one pass
+        if '#' in jira_text:
+            jira_text = RE_HEADER.sub(lambda m: f'h{len(m.group(1))}. {m.group(2)}', jira_text)
         
-        # Get and attach files
-        if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
-            for attachment in attachments:
-                if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
-                    filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
+        # Bold, italic (_text_ is already JIRA italic), strikethrough, code and links
+        if any(marker in jira_text for marker in INLINE_MARKERS):
+            jira_text = RE_INLINE.sub(inline_markup, jira_text)
         
-        # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
-            sender_name=sender_name,
-            ticket_key=jira_issue.key,
-            ticket_summary=subject,
-            ticket_url=f"{JIRA_URL}/browse/{jira_issue.key}",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
+        # Unordered lists: * item -> * item (same in JIRA)
+        # Ordered lists: 1. item -> # item
+        if '.' in jira_text:
+            jira_text = RE_ORDERED_ITEM.sub('# ', jira_text)
         
-        graph_client.send_email(
-            to_email=sender_email,
-            subject=f"Your request has been converted to ticket {jira_issue.key}",
-            html_body=html_body
-        )
+        # Blockquotes: runs of "> text" lines -> {quote}text{quote}
+        if '> ' in jira_text:
+            jira_text = RE_QUOTE_BLOCK.sub(quote_block, jira_text)
         
-        # Delete the processed email from the folder
-        graph_client.delete_message(message_id)
+        # Clean up excessive newlines
+        if '\n\n\n' in jira_text:
+            jira_text = RE_EXCESS_NEWLINES.sub('\n\n', jira_text)
         
-        logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
-        return True
+        return jira_text.strip()
         
     except Exception as e:
-        logger.error(f"Error processing email {email_message.get('id')}: {e}", exc_info=True)
-        return False
+        logger.warning(f"Error converting HTML to JIRA markup: {e}")
+        # Fallback: just extract plain text
+        return fast_strip_html(html_content)
 
 
-def main():
-    """Main execution function"""
-    logger.info("=" * 80)
-    logger.info("Starting Email to JIRA Converter (MSAL ROPC)")
-    logger.info("=" * 80)
+def extract_email_body(email_message: Dict) -> str:
+    """Extract and convert email body to JIRA-compatible format"""
+    body = email_message.get('body', {})
+    content = body.get('content', '')
+    content_type = body.get('contentType', 'text')
     
-    try:
-        # Initialize clients
-        graph_client = GraphAPIClient(
-            tenant_id=TENANT_ID,
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            username=MAILBOX_USER,
-            password=MAILBOX_PASSWORD
-        )
-        
-        jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
-        
-        # Get folder ID
-        folder_id = graph_client.get_folder_id(FOLDER_NAME)
-        if not folder_id:
-            logger.error(f"Could not find folder '{FOLDER_NAME}'")
-            return
-        
-        # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
-        
-        if not messages:
-            logger.info("No messages to process")
-            return
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
-        
-        logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
-        
-    except Exception as e:
-        logger.error(f"Fatal error in main execution: {e}", exc_info=True)
-        raise
+    if not content:
+        return "_(No content)_"
     
-    logger.info("Email to JIRA Converter finished")
-    logger.info("=" * 80)
+    if content_type.lower() == 'html':
+        # Convert HTML to JIRA markup
+        return html_to_jira_markup(content)
+    else:
+        # Plain text - escape JIRA special characters if needed
+        # But keep it mostly as-is
+        return content.strip()
 
 
-if __name__ == '__main__':
-    main()
-, r'h1. \1', jira_text, flags=re.MULTILINE)
-        jira_text = re.sub(r'^## (.+)
+# Attachment downloads; kept apart from the per-email pool in main so nested submits cannot deadlock
+ATTACHMENT_POOL = ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS)
+
+
+def create_ticket_for_email(jira_client: JiraTicketCreator, email_message: Dict,
+                            processed: Optional[ProcessedStore], dedup_id: str) -> str:
+    """Create the JIRA ticket for an email and record it, returning the ticket key"""
+    subject = email_message.get('subject', 'No Subject')
+    sender = email_message['from']['emailAddress']
+    sender_email = sender['address']
+    sender_name = sender.get('name', sender_email)
+    received_date = email_message.get('receivedDateTime', '')
+    
+    logger.info(f"Processing email from {sender_email}: {subject}")
+    
+    # Extract body
+    body = extract_email_body(email_message)
+    
+    # Prepare description with metadata
+    description = f"""*Original Email from:* {sender_name} <{sender_email}>
+*Received:* {received_date}
+*Subject:* {subject}
+
+----
+
+{body}
+"""
+    
+    # Create JIRA ticket
+    jira_issue = jira_client.create_ticket(
+        summary=subject,
+        description=description,
+        project_key=JIRA_PROJECT_KEY
+    )
+    # Recorded at once, so no later run creates a second ticket; the
+    # attachments count as pending until they reach the ticket
+    if processed is not None:
+        processed.add(dedup_id, jira_issue.key, attachments_pending=bool(email_message.get('hasAttachments')))
+    return jira_issue.key
+
+
+def attach_email_files(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, message_id: str,
+                       attachments: List[Dict], issue_key: str, retry: bool = False) -> bool:
+    """Copy an email's file attachments to its ticket, returning whether all of them got there
+    
+    On a retry, files the ticket already has are skipped.
+    """
+    try:
+        files = [a for a in attachments if a.get('@odata.type') == '#microsoft.graph.fileAttachment']
+        if retry and files:
+            existing = jira_client.attachment_names(issue_key)
+            files = [a for a in files if a['name'] not in existing]
+        if not files:
+            return True
+        
+        # Downloads overlap on the attachment pool; the upload is a single request
+        downloads = [
+            ATTACHMENT_POOL.submit(graph_client.get_attachment_content, message_id, attachment['id'])
+            for attachment in files
+        ]
+        with ExitStack() as stack:
+            file_objs = [stack.enter_context(download.result()) for download in downloads]
+            return jira_client.add_attachments(
+                issue_key,
+                [(attachment['name'], file_obj) for attachment, file_obj in zip(files, file_objs)]
+            )
+    except Exception as e:
+        logger.error(f"Error copying attachments of email {message_id} to {issue_key}: {e}")
+        return False
 
 
 def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
+                          email_message: Dict, attachments: List[Dict] = None,
+                          processed: ProcessedStore = None) -> Optional[Dict]:
+    """Process a single email and create a JIRA ticket
+    
+    attachments may be prefetched with GraphAPIClient.get_attachments_batch;
+    when omitted they are fetched here for messages that have any. Returns the
+    follow-up for GraphAPIClient.reply_and_delete_batch, or None on failure.
+    Emails already recorded in processed only get their delete, unless their
+    ticket is still missing attachments: then only those are uploaded again.
+    An email stays in the folder until its ticket has all its attachments.
+    """
     
     try:
         # Extract email details
@@ -545,64 +979,55 @@ def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketC
         sender_email = sender['address']
         sender_name = sender.get('name', sender_email)
         message_id = email_message['id']
-        received_date = email_message.get('receivedDateTime', '')
-        
-        logger.info(f"Processing email from {sender_email}: {subject}")
+        dedup_id = email_message.get('internetMessageId') or message_id
         
-        # Extract body
-        body = extract_email_body(email_message)
-        
-        # Prepare description with metadata
-        description = f"""*Original Email from:* {sender_name} <{sender_email}>
-*Received:* {received_date}
-*Subject:* {subject}
-
-----
-
-{body}
-"""
+        issue_key = processed.get(dedup_id) if processed is not None else None
+        retry = issue_key is not None
+        if retry and not processed.attachments_pending(dedup_id):
+            logger.info(f"Email already converted to ticket {issue_key}, removing it")
+            return {'message_id': message_id}
         
-        # Create JIRA ticket
-        jira_issue = jira_client.create_ticket(
-            summary=subject,
-            description=description,
-            project_key=JIRA_PROJECT_KEY
-        )
+        if retry:
+            logger.info(f"Retrying attachments of ticket {issue_key} for email from {sender_email}")
+        else:
+            issue_key = create_ticket_for_email(jira_client, email_message, processed, dedup_id)
         
         # Get and attach files
         if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
-            for attachment in attachments:
-                if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
-                    filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
+            if attachments is None:
+                attachments = graph_client.get_attachments(message_id)
+            if not attach_email_files(graph_client, jira_client, message_id, attachments, issue_key, retry):
+                # The ticket is recorded as missing attachments; keep the email so
+                # the next run uploads them instead of converting it again
+                logger.error(f"Ticket {issue_key} is missing attachments, keeping email {message_id}")
+                return None
+            if processed is not None:
+                processed.attachments_done(dedup_id)
         
         # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
+        html_body = CONFIRMATION_TEMPLATE.render(
             sender_name=sender_name,
-            ticket_key=jira_issue.key,
+            ticket_key=issue_key,
             ticket_summary=subject,
-            ticket_url=f"{JIRA_URL}/browse/{jira_issue.key}",
+            ticket_url=f"{JIRA_URL}/browse/{issue_key}",
             timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         )
         
-        graph_client.send_email(
-            to_email=sender_email,
-            subject=f"Your request has been converted to ticket {jira_issue.key}",
-            html_body=html_body
-        )
-        
-        # Delete the processed email from the folder
-        graph_client.delete_message(message_id)
+        logger.info(f"Successfully processed email and created ticket {issue_key}")
         
-        logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
-        return True
+        # Confirmation and delete are sent in batches once all tickets exist
+        return {
+            'message_id': message_id,
+            'reply': {
+                'to_email': sender_email,
+                'subject': f"Your request has been converted to ticket {issue_key}",
+                'html_body': html_body
+            }
+        }
         
     except Exception as e:
         logger.error(f"Error processing email {email_message.get('id')}: {e}", exc_info=True)
-        return False
+        return None
 
 
 def main():
@@ -622,6 +1047,7 @@ def main():
         )
         
         jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
+        processed = ProcessedStore(PROCESSED_DB)
         
         # Get folder ID
         folder_id = graph_client.get_folder_id(FOLDER_NAME)
@@ -630,838 +1056,38 @@ def main():
             return
         
         # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
-        
-        if not messages:
-            logger.info("No messages to process")
-            return
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
-        
-        logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
-        
-    except Exception as e:
-        logger.error(f"Fatal error in main execution: {e}", exc_info=True)
-        raise
-    
-    logger.info("Email to JIRA Converter finished")
-    logger.info("=" * 80)
-
-
-if __name__ == '__main__':
-    main()
-, r'h2. \1', jira_text, flags=re.MULTILINE)
-        jira_text = re.sub(r'^### (.+)
-
-
-def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
-    
-    try:
-        # Extract email details
-        subject = email_message.get('subject', 'No Subject')
-        sender = email_message['from']['emailAddress']
-        sender_email = sender['address']
-        sender_name = sender.get('name', sender_email)
-        message_id = email_message['id']
-        received_date = email_message.get('receivedDateTime', '')
-        
-        logger.info(f"Processing email from {sender_email}: {subject}")
-        
-        # Extract body
-        body = extract_email_body(email_message)
-        
-        # Prepare description with metadata
-        description = f"""*Original Email from:* {sender_name} <{sender_email}>
-*Received:* {received_date}
-*Subject:* {subject}
-
-----
-
-{body}
-"""
-        
-        # Create JIRA ticket
-        jira_issue = jira_client.create_ticket(
-            summary=subject,
-            description=description,
-            project_key=JIRA_PROJECT_KEY
-        )
-        
-        # Get and attach files
-        if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
-            for attachment in attachments:
-                if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
-                    filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
-        
-        # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
-            sender_name=sender_name,
-            ticket_key=jira_issue.key,
-            ticket_summary=subject,
-            ticket_url=f"{JIRA_URL}/browse/{jira_issue.key}",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
-        
-        graph_client.send_email(
-            to_email=sender_email,
-            subject=f"Your request has been converted to ticket {jira_issue.key}",
-            html_body=html_body
-        )
-        
-        # Delete the processed email from the folder
-        graph_client.delete_message(message_id)
-        
-        logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing email {email_message.get('id')}: {e}", exc_info=True)
-        return False
-
-
-def main():
-    """Main execution function"""
-    logger.info("=" * 80)
-    logger.info("Starting Email to JIRA Converter (MSAL ROPC)")
-    logger.info("=" * 80)
-    
-    try:
-        # Initialize clients
-        graph_client = GraphAPIClient(
-            tenant_id=TENANT_ID,
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            username=MAILBOX_USER,
-            password=MAILBOX_PASSWORD
-        )
-        
-        jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
-        
-        # Get folder ID
-        folder_id = graph_client.get_folder_id(FOLDER_NAME)
-        if not folder_id:
-            logger.error(f"Could not find folder '{FOLDER_NAME}'")
-            return
-        
-        # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
-        
-        if not messages:
-            logger.info("No messages to process")
-            return
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
-        
-        logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
-        
-    except Exception as e:
-        logger.error(f"Fatal error in main execution: {e}", exc_info=True)
-        raise
-    
-    logger.info("Email to JIRA Converter finished")
-    logger.info("=" * 80)
-
-
-if __name__ == '__main__':
-    main()
-, r'h3. \1', jira_text, flags=re.MULTILINE)
-        jira_text = re.sub(r'^#### (.+)
-
-
-def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
-    
-    try:
-        # Extract email details
-        subject = email_message.get('subject', 'No Subject')
-        sender = email_message['from']['emailAddress']
-        sender_email = sender['address']
-        sender_name = sender.get('name', sender_email)
-        message_id = email_message['id']
-        received_date = email_message.get('receivedDateTime', '')
-        
-        logger.info(f"Processing email from {sender_email}: {subject}")
-        
-        # Extract body
-        body = extract_email_body(email_message)
-        
-        # Prepare description with metadata
-        description = f"""*Original Email from:* {sender_name} <{sender_email}>
-*Received:* {received_date}
-*Subject:* {subject}
-
-----
-
-{body}
-"""
-        
-        # Create JIRA ticket
-        jira_issue = jira_client.create_ticket(
-            summary=subject,
-            description=description,
-            project_key=JIRA_PROJECT_KEY
-        )
-        
-        # Get and attach files
-        if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
-            for attachment in attachments:
-                if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
-                    filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
-        
-        # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
-            sender_name=sender_name,
-            ticket_key=jira_issue.key,
-            ticket_summary=subject,
-            ticket_url=f"{JIRA_URL}/browse/{jira_issue.key}",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
-        
-        graph_client.send_email(
-            to_email=sender_email,
-            subject=f"Your request has been converted to ticket {jira_issue.key}",
-            html_body=html_body
-        )
-        
-        # Delete the processed email from the folder
-        graph_client.delete_message(message_id)
-        
-        logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing email {email_message.get('id')}: {e}", exc_info=True)
-        return False
-
-
-def main():
-    """Main execution function"""
-    logger.info("=" * 80)
-    logger.info("Starting Email to JIRA Converter (MSAL ROPC)")
-    logger.info("=" * 80)
-    
-    try:
-        # Initialize clients
-        graph_client = GraphAPIClient(
-            tenant_id=TENANT_ID,
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            username=MAILBOX_USER,
-            password=MAILBOX_PASSWORD
-        )
-        
-        jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
-        
-        # Get folder ID
-        folder_id = graph_client.get_folder_id(FOLDER_NAME)
-        if not folder_id:
-            logger.error(f"Could not find folder '{FOLDER_NAME}'")
-            return
-        
-        # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
-        
-        if not messages:
-            logger.info("No messages to process")
-            return
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
-        
-        logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
-        
-    except Exception as e:
-        logger.error(f"Fatal error in main execution: {e}", exc_info=True)
-        raise
-    
-    logger.info("Email to JIRA Converter finished")
-    logger.info("=" * 80)
-
-
-if __name__ == '__main__':
-    main()
-, r'h4. \1', jira_text, flags=re.MULTILINE)
-        jira_text = re.sub(r'^##### (.+)
-
-
-def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
-    
-    try:
-        # Extract email details
-        subject = email_message.get('subject', 'No Subject')
-        sender = email_message['from']['emailAddress']
-        sender_email = sender['address']
-        sender_name = sender.get('name', sender_email)
-        message_id = email_message['id']
-        received_date = email_message.get('receivedDateTime', '')
-        
-        logger.info(f"Processing email from {sender_email}: {subject}")
-        
-        # Extract body
-        body = extract_email_body(email_message)
-        
-        # Prepare description with metadata
-        description = f"""*Original Email from:* {sender_name} <{sender_email}>
-*Received:* {received_date}
-*Subject:* {subject}
-
-----
-
-{body}
-"""
-        
-        # Create JIRA ticket
-        jira_issue = jira_client.create_ticket(
-            summary=subject,
-            description=description,
-            project_key=JIRA_PROJECT_KEY
-        )
-        
-        # Get and attach files
-        if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
-            for attachment in attachments:
-                if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
-                    filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
-        
-        # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
-            sender_name=sender_name,
-            ticket_key=jira_issue.key,
-            ticket_summary=subject,
-            ticket_url=f"{JIRA_URL}/browse/{jira_issue.key}",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
-        
-        graph_client.send_email(
-            to_email=sender_email,
-            subject=f"Your request has been converted to ticket {jira_issue.key}",
-            html_body=html_body
-        )
-        
-        # Delete the processed email from the folder
-        graph_client.delete_message(message_id)
-        
-        logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing email {email_message.get('id')}: {e}", exc_info=True)
-        return False
-
-
-def main():
-    """Main execution function"""
-    logger.info("=" * 80)
-    logger.info("Starting Email to JIRA Converter (MSAL ROPC)")
-    logger.info("=" * 80)
-    
-    try:
-        # Initialize clients
-        graph_client = GraphAPIClient(
-            tenant_id=TENANT_ID,
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            username=MAILBOX_USER,
-            password=MAILBOX_PASSWORD
-        )
-        
-        jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
-        
-        # Get folder ID
-        folder_id = graph_client.get_folder_id(FOLDER_NAME)
-        if not folder_id:
-            logger.error(f"Could not find folder '{FOLDER_NAME}'")
-            return
-        
-        # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
-        
-        if not messages:
-            logger.info("No messages to process")
-            return
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
-        
-        logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
-        
-    except Exception as e:
-        logger.error(f"Fatal error in main execution: {e}", exc_info=True)
-        raise
-    
-    logger.info("Email to JIRA Converter finished")
-    logger.info("=" * 80)
-
-
-if __name__ == '__main__':
-    main()
-, r'h5. \1', jira_text, flags=re.MULTILINE)
-        jira_text = re.sub(r'^###### (.+)
-
-
-def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
-    
-    try:
-        # Extract email details
-        subject = email_message.get('subject', 'No Subject')
-        sender = email_message['from']['emailAddress']
-        sender_email = sender['address']
-        sender_name = sender.get('name', sender_email)
-        message_id = email_message['id']
-        received_date = email_message.get('receivedDateTime', '')
-        
-        logger.info(f"Processing email from {sender_email}: {subject}")
-        
-        # Extract body
-        body = extract_email_body(email_message)
-        
-        # Prepare description with metadata
-        description = f"""*Original Email from:* {sender_name} <{sender_email}>
-*Received:* {received_date}
-*Subject:* {subject}
-
-----
-
-{body}
-"""
-        
-        # Create JIRA ticket
-        jira_issue = jira_client.create_ticket(
-            summary=subject,
-            description=description,
-            project_key=JIRA_PROJECT_KEY
-        )
-        
-        # Get and attach files
-        if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
-            for attachment in attachments:
-                if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
-                    filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
-        
-        # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
-            sender_name=sender_name,
-            ticket_key=jira_issue.key,
-            ticket_summary=subject,
-            ticket_url=f"{JIRA_URL}/browse/{jira_issue.key}",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
-        
-        graph_client.send_email(
-            to_email=sender_email,
-            subject=f"Your request has been converted to ticket {jira_issue.key}",
-            html_body=html_body
-        )
-        
-        # Delete the processed email from the folder
-        graph_client.delete_message(message_id)
-        
-        logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing email {email_message.get('id')}: {e}", exc_info=True)
-        return False
-
-
-def main():
-    """Main execution function"""
-    logger.info("=" * 80)
-    logger.info("Starting Email to JIRA Converter (MSAL ROPC)")
-    logger.info("=" * 80)
-    
-    try:
-        # Initialize clients
-        graph_client = GraphAPIClient(
-            tenant_id=TENANT_ID,
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            username=MAILBOX_USER,
-            password=MAILBOX_PASSWORD
-        )
-        
-        jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
-        
-        # Get folder ID
-        folder_id = graph_client.get_folder_id(FOLDER_NAME)
-        if not folder_id:
-            logger.error(f"Could not find folder '{FOLDER_NAME}'")
-            return
-        
-        # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
-        
-        if not messages:
-            logger.info("No messages to process")
-            return
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
-        
-        logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
-        
-    except Exception as e:
-        logger.error(f"Fatal error in main execution: {e}", exc_info=True)
-        raise
-    
-    logger.info("Email to JIRA Converter finished")
-    logger.info("=" * 80)
-
-
-if __name__ == '__main__':
-    main()
-, r'h6. \1', jira_text, flags=re.MULTILINE)
-        
-        # Bold: **text** or __text__ -> *text*
-        jira_text = re.sub(r'\*\*(.+?)\*\*', r'*\1*', jira_text)
-        jira_text = re.sub(r'__(.+?)__', r'*\1*', jira_text)
-        
-        # Italic: *text* or _text_ -> _text_
-        jira_text = re.sub(r'(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)', r'_\1_', jira_text)
-        jira_text = re.sub(r'(?<!_)_(?!_)(.+?)(?<!_)_(?!_)', r'_\1_', jira_text)
-        
-        # Strikethrough: ~~text~~ -> -text-
-        jira_text = re.sub(r'~~(.+?)~~', r'-\1-', jira_text)
-        
-        # Code blocks: ```code``` -> {code}code{code}
-        jira_text = re.sub(r'```(.+?)```', r'{code}\1{code}', jira_text, flags=re.DOTALL)
-        
-        # Inline code: `code` -> {{code}}
-        jira_text = re.sub(r'`(.+?)`', r'{{\1}}', jira_text)
-        
-        # Links: [text](url) -> [text|url]
-        jira_text = re.sub(r'\[(.+?)\]\((.+?)\)', r'[\1|\2]', jira_text)
-        
-        # Unordered lists: * item -> * item (same in JIRA)
-        # Ordered lists: 1. item -> # item
-        jira_text = re.sub(r'^\d+\.\s', '# ', jira_text, flags=re.MULTILINE)
-        
-        # Blockquotes: > text -> {quote}text{quote}
-        quote_pattern = r'^> (.+)
-
-
-def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
-    
-    try:
-        # Extract email details
-        subject = email_message.get('subject', 'No Subject')
-        sender = email_message['from']['emailAddress']
-        sender_email = sender['address']
-        sender_name = sender.get('name', sender_email)
-        message_id = email_message['id']
-        received_date = email_message.get('receivedDateTime', '')
-        
-        logger.info(f"Processing email from {sender_email}: {subject}")
-        
-        # Extract body
-        body = extract_email_body(email_message)
-        
-        # Prepare description with metadata
-        description = f"""*Original Email from:* {sender_name} <{sender_email}>
-*Received:* {received_date}
-*Subject:* {subject}
-
-----
-
-{body}
-"""
-        
-        # Create JIRA ticket
-        jira_issue = jira_client.create_ticket(
-            summary=subject,
-            description=description,
-            project_key=JIRA_PROJECT_KEY
-        )
-        
-        # Get and attach files
-        if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
-            for attachment in attachments:
-                if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
-                    filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
-        
-        # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
-            sender_name=sender_name,
-            ticket_key=jira_issue.key,
-            ticket_summary=subject,
-            ticket_url=f"{JIRA_URL}/browse/{jira_issue.key}",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
-        
-        graph_client.send_email(
-            to_email=sender_email,
-            subject=f"Your request has been converted to ticket {jira_issue.key}",
-            html_body=html_body
-        )
-        
-        # Delete the processed email from the folder
-        graph_client.delete_message(message_id)
-        
-        logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing email {email_message.get('id')}: {e}", exc_info=True)
-        return False
-
-
-def main():
-    """Main execution function"""
-    logger.info("=" * 80)
-    logger.info("Starting Email to JIRA Converter (MSAL ROPC)")
-    logger.info("=" * 80)
-    
-    try:
-        # Initialize clients
-        graph_client = GraphAPIClient(
-            tenant_id=TENANT_ID,
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            username=MAILBOX_USER,
-            password=MAILBOX_PASSWORD
-        )
-        
-        jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
-        
-        # Get folder ID
-        folder_id = graph_client.get_folder_id(FOLDER_NAME)
-        if not folder_id:
-            logger.error(f"Could not find folder '{FOLDER_NAME}'")
-            return
-        
-        # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
-        
-        if not messages:
-            logger.info("No messages to process")
-            return
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
-        
-        logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
-        
-    except Exception as e:
-        logger.error(f"Fatal error in main execution: {e}", exc_info=True)
-        raise
-    
-    logger.info("Email to JIRA Converter finished")
-    logger.info("=" * 80)
-
-
-if __name__ == '__main__':
-    main()
-
-        if re.search(quote_pattern, jira_text, flags=re.MULTILINE):
-            # Find all consecutive quote lines and wrap them
-            lines = jira_text.split('\n')
-            result = []
-            in_quote = False
-            quote_content = []
-            
-            for line in lines:
-                if line.startswith('> '):
-                    if not in_quote:
-                        in_quote = True
-                    quote_content.append(line[2:])
-                else:
-                    if in_quote:
-                        result.append('{quote}' + '\n'.join(quote_content) + '{quote}')
-                        quote_content = []
-                        in_quote = False
-                    result.append(line)
-            
-            if in_quote:
-                result.append('{quote}' + '\n'.join(quote_content) + '{quote}')
-            
-            jira_text = '\n'.join(result)
-        
-        # Clean up excessive newlines
-        jira_text = re.sub(r'\n{3,}', '\n\n', jira_text)
-        
-        return jira_text.strip()
-        
-    except Exception as e:
-        logger.warning(f"Error converting HTML to JIRA markup: {e}")
-        # Fallback: just extract plain text
-        soup = BeautifulSoup(html_content, 'html.parser')
-        return soup.get_text(separator='\n', strip=True)
-
-
-def extract_email_body(email_message: Dict) -> str:
-    """Extract and convert email body to JIRA-compatible format"""
-    body = email_message.get('body', {})
-    content = body.get('content', '')
-    content_type = body.get('contentType', 'text')
-    
-    if not content:
-        return "_(No content)_"
-    
-    if content_type.lower() == 'html':
-        # Convert HTML to JIRA markup
-        return html_to_jira_markup(content)
-    else:
-        # Plain text - escape JIRA special characters if needed
-        # But keep it mostly as-is
-        return content.strip()
-
-
-def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
-    
-    try:
-        # Extract email details
-        subject = email_message.get('subject', 'No Subject')
-        sender = email_message['from']['emailAddress']
-        sender_email = sender['address']
-        sender_name = sender.get('name', sender_email)
-        message_id = email_message['id']
-        received_date = email_message.get('receivedDateTime', '')
-        
-        logger.info(f"Processing email from {sender_email}: {subject}")
-        
-        # Extract body
-        body = extract_email_body(email_message)
-        
-        # Prepare description with metadata
-        description = f"""*Original Email from:* {sender_name} <{sender_email}>
-*Received:* {received_date}
-*Subject:* {subject}
-
-----
-
-{body}
-"""
-        
-        # Create JIRA ticket
-        jira_issue = jira_client.create_ticket(
-            summary=subject,
-            description=description,
-            project_key=JIRA_PROJECT_KEY
-        )
-        
-        # Get and attach files
-        if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
-            for attachment in attachments:
-                if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
-                    filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
-        
-        # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
-            sender_name=sender_name,
-            ticket_key=jira_issue.key,
-            ticket_summary=subject,
-            ticket_url=f"{JIRA_URL}/browse/{jira_issue.key}",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
-        
-        graph_client.send_email(
-            to_email=sender_email,
-            subject=f"Your request has been converted to ticket {jira_issue.key}",
-            html_body=html_body
-        )
-        
-        # Delete the processed email from the folder
-        graph_client.delete_message(message_id)
-        
-        logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing email {email_message.get('id')}: {e}", exc_info=True)
-        return False
-
-
-def main():
-    """Main execution function"""
-    logger.info("=" * 80)
-    logger.info("Starting Email to JIRA Converter (MSAL ROPC)")
-    logger.info("=" * 80)
-    
-    try:
-        # Initialize clients
-        graph_client = GraphAPIClient(
-            tenant_id=TENANT_ID,
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            username=MAILBOX_USER,
-            password=MAILBOX_PASSWORD
-        )
-        
-        jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
-        
-        # Get folder ID
-        folder_id = graph_client.get_folder_id(FOLDER_NAME)
-        if not folder_id:
-            logger.error(f"Could not find folder '{FOLDER_NAME}'")
-            return
-        
-        # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
+        try:
+            messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            # Cached folder ID is stale (folder recreated) - resolve it again
+            folder_id = graph_client.get_folder_id(FOLDER_NAME, refresh=True)
+            if not folder_id:
+                logger.error(f"Could not find folder '{FOLDER_NAME}'")
+                return
+            messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
         
         if not messages:
             logger.info("No messages to process")
             return
         
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
+        # Fetch attachment lists for all messages in batched requests
+        attachment_ids = [m['id'] for m in messages if m.get('hasAttachments')]
+        attachments = graph_client.get_attachments_batch(attachment_ids) if attachment_ids else {}
+        
+        # Process messages in parallel - the work is network bound
+        with ThreadPoolExecutor(max_workers=JIRA_WORKERS) as executor:
+            futures = [
+                executor.submit(process_email_to_jira, graph_client, jira_client,
+                                message, attachments.get(message['id']), processed)
+                for message in messages
+            ]
+            followups = [future.result() for future in as_completed(futures)]
+        
+        # Send confirmations and clear the folder in batched Graph calls
+        followups = [followup for followup in followups if followup]
+        success_count = graph_client.reply_and_delete_batch(followups) if followups else 0
         
         logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
         
@@ -6,15 +6,24 @@ Uses MSAL with ROPC (Resource Owner Password Credentials) flow
 """
 
 import os
+import time
+import atexit
 import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, IO, Optional
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from jira import JIRA
-from jinja2 import Template
-import base64
+from jinja2 import Environment
 import msal
 
+from conv import html_to_jira_markup
+from token_cache import TOKEN_CACHE_FILE
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -42,10 +51,40 @@ JIRA_URL = os.getenv('JIRA_URL', 'https://your-company.atlassian.net')
 JIRA_USER = os.getenv('JIRA_USER', 'jira-user@domain.com')
 JIRA_PASSWORD = os.getenv('JIRA_PASSWORD', 'jira-password')
 JIRA_PROJECT_KEY = 'IAM'
+JIRA_RATE_LIMIT = float(os.getenv('JIRA_RATE_LIMIT', '10'))  # Max JIRA calls per second
 
 # Processing Configuration
 FOLDER_NAME = '#As_JIRA_Ticket'
 BATCH_SIZE = int(os.getenv('BATCH_SIZE', '10'))  # Max emails per run
+JIRA_WORKERS = int(os.getenv('JIRA_WORKERS', '8'))  # Emails processed in parallel
+GRAPH_BATCH_LIMIT = 20  # Max requests per Graph $batch call
+ATTACHMENT_SELECT = 'id,name,contentType,size'  # Attachment metadata only, no contentBytes
+ATTACHMENT_CHUNK_SIZE = 64 * 1024  # Attachment download read size
+ATTACHMENT_SPOOL_SIZE = 2 * 1024 * 1024  # Attachments above this spill to disk
+
+
+class PostSafeRetry(Retry):
+    """Retry that only repeats a POST the server turned away
+    
+    Graph can answer a POST (sendMail, $batch) with a 5xx after it has already
+    acted on it, so a POST is only retried on 429/503 carrying Retry-After.
+    """
+    
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == 'POST':
+            return bool(self.total) and has_retry_after and status_code in (429, 503)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# Retry throttled (429) and transient server errors on the pooled session.
+# POST is left out of allowed_methods so a read timeout never resends it.
+HTTP_RETRY = PostSafeRetry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset(['GET', 'DELETE']),
+    raise_on_status=False  # Let raise_for_status report the final response
+)
 
 # ============================================================================
 # EMAIL TEMPLATE
@@ -151,6 +190,9 @@ EMAIL_TEMPLATE = """
 </html>
 """
 
+# Compiled once; autoescape keeps sender-controlled fields from injecting HTML
+CONFIRMATION_TEMPLATE = Environment(autoescape=True).from_string(EMAIL_TEMPLATE)
+
 
 class GraphAPIClient:
     """Handles Microsoft Graph API authentication and operations using MSAL"""
@@ -163,22 +205,66 @@ class GraphAPIClient:
         self.username = username
         self.password = password
         self.access_token = None
+        self.token_expires_at = 0.0
+        self.headers = {}
+        self._token_lock = threading.Lock()
         self.graph_endpoint = 'https://graph.microsoft.com/v1.0'
         
-        # Initialize MSAL Confidential Client Application
+        # One keep-alive session for Graph and the token endpoint
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=HTTP_RETRY))
+        
+        # Initialize MSAL Confidential Client Application with a token cache
+        # persisted across runs, so warm starts skip the token endpoint
+        self._cache = msal.SerializableTokenCache()
+        if os.path.exists(TOKEN_CACHE_FILE):
+            with open(TOKEN_CACHE_FILE, 'r') as f:
+                self._cache.deserialize(f.read())
+        atexit.register(self._save_cache)
+        
         authority = f'https://login.microsoftonline.com/{tenant_id}'
         self.app = msal.ConfidentialClientApplication(
             client_id=client_id,
             client_credential=client_secret,
-            authority=authority
+            authority=authority,
+            token_cache=self._cache,
+            http_client=self._session
         )
     
-    def get_access_token(self) -> str:
-        """Obtain access token using ROPC (Resource Owner Password Credentials) flow"""
+    def _save_cache(self):
+        """Write the MSAL token cache back to disk if it changed"""
+        if not self._cache.has_state_changed:
+            return
+        os.makedirs(os.path.dirname(TOKEN_CACHE_FILE) or '.', exist_ok=True)
+        # Cache holds refresh tokens - keep it readable by the owner only
+        fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self._cache.serialize())
+    
+    def close(self):
+        """Release pooled connections"""
+        self._session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def get_access_token(self, force_refresh: bool = False) -> str:
+        """Obtain access token from the MSAL cache (past a rejected cached token if force_refresh), falling back to ROPC flow"""
         scopes = ['https://graph.microsoft.com/.default']
         
         try:
-            # Try ROPC flow
+            # Try cached token / refresh token first
+            accounts = self.app.get_accounts(username=self.username)
+            if accounts:
+                result = self.app.acquire_token_silent(scopes, account=accounts[0], force_refresh=force_refresh)
+                if result and "access_token" in result:
+                    logger.info("Successfully obtained access token from cache")
+                    return self._store_token(result)
+            
+            # Cache miss - try ROPC flow
             result = self.app.acquire_token_by_username_password(
                 username=self.username,
                 password=self.password,
@@ -186,9 +272,8 @@ class GraphAPIClient:
             )
             
             if "access_token" in result:
-                self.access_token = result['access_token']
                 logger.info("Successfully obtained access token via ROPC")
-                return self.access_token
+                return self._store_token(result)
             else:
                 error = result.get("error")
                 error_desc = result.get("error_description")
@@ -199,9 +284,8 @@ class GraphAPIClient:
                 result = self.app.acquire_token_for_client(scopes=scopes)
                 
                 if "access_token" in result:
-                    self.access_token = result['access_token']
                     logger.info("Successfully obtained access token via client credentials")
-                    return self.access_token
+                    return self._store_token(result)
                 else:
                     raise Exception(f"Authentication failed: {result.get('error_description')}")
                     
@@ -209,40 +293,89 @@ class GraphAPIClient:
             logger.error(f"Failed to obtain access token: {e}")
             raise
     
-    def _get_headers(self) -> Dict[str, str]:
-        """Get authorization headers"""
-        if not self.access_token:
-            self.get_access_token()
-        return {
+    def _store_token(self, result: Dict) -> str:
+        """Keep the token from an MSAL result along with when to renew it"""
+        self.access_token = result['access_token']
+        # Renew a minute early so in-flight requests never carry an expired token
+        self.token_expires_at = time.time() + int(result.get('expires_in', 0)) - 60
+        # Graph-only headers, built once per token. They stay off the session,
+        # which MSAL also uses for the token endpoint.
+        self.headers = {
             'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json'
         }
+        return self.access_token
+    
+    def _get_headers(self) -> Dict[str, str]:
+        """Get authorization headers, renewing the token once it is about to expire"""
+        if not self.access_token or time.time() >= self.token_expires_at:
+            with self._token_lock:
+                # Another worker may have renewed it while we waited
+                if not self.access_token or time.time() >= self.token_expires_at:
+                    self.get_access_token()
+        return self.headers
+    
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a Graph request, renewing the token and retrying once on 401"""
+        headers = self._get_headers()
+        response = self._session.request(method, url, headers=headers, **kwargs)
+        if response.status_code == 401:
+            logger.info("Access token rejected, renewing and retrying")
+            response.close()
+            with self._token_lock:
+                # Bypass the MSAL cache, which would hand back the rejected token,
+                # unless another worker has already replaced it
+                if self.headers is headers:
+                    self.get_access_token(force_refresh=True)
+            response = self._session.request(method, url, headers=self.headers, **kwargs)
+        return response
     
     def get_folder_id(self, folder_name: str) -> str:
         """Get the folder ID for a specific folder name"""
         # Using 'me' endpoint since we're authenticating as the user
         url = f'{self.graph_endpoint}/me/mailFolders'
+        # Child folders come back inline, so one request covers two levels
+        params = {
+            '$top': 100,
+            '$select': 'id,displayName,childFolderCount',
+            '$expand': 'childFolders($select=id,displayName)'
+        }
         
         try:
-            response = requests.get(url, headers=self._get_headers())
+            response = self._request('GET', url, params=params)
             response.raise_for_status()
             folders = response.json()['value']
             
-            # Search in all folders including subfolders
+            # Search the top-level folders first
             for folder in folders:
                 if folder['displayName'] == folder_name:
                     logger.info(f"Found folder '{folder_name}' with ID: {folder['id']}")
                     return folder['id']
-                
-                # Check child folders
-                child_url = f"{self.graph_endpoint}/me/mailFolders/{folder['id']}/childFolders"
-                child_response = requests.get(child_url, headers=self._get_headers())
-                if child_response.ok:
-                    child_folders = child_response.json().get('value', [])
-                    for child in child_folders:
-                        if child['displayName'] == folder_name:
-                            logger.info(f"Found folder '{folder_name}' with ID: {child['id']}")
-                            return child['id']
+            
+            # Then their expanded children, noting folders whose list was cut short
+            truncated = []
+            for folder in folders:
+                children = folder.get('childFolders', [])
+                for child in children:
+                    if child['displayName'] == folder_name:
+                        logger.info(f"Found folder '{folder_name}' with ID: {child['id']}")
+                        return child['id']
+                if folder.get('childFolderCount', 0) > len(children):
+                    truncated.append(folder)
+            
+            # Fetch the complete child lists of truncated folders with batched requests
+            responses = self.batch([
+                {'id': str(i), 'method': 'GET', 'url': f"/me/mailFolders/{folder['id']}/childFolders?$top=100"}
+                for i, folder in enumerate(truncated)
+            ])
+            for i in range(len(truncated)):
+                item = responses.get(str(i), {})
+                if item.get('status') != 200:
+                    continue
+                for child in item['body'].get('value', []):
+                    if child['displayName'] == folder_name:
+                        logger.info(f"Found folder '{folder_name}' with ID: {child['id']}")
+                        return child['id']
             
             logger.error(f"Folder '{folder_name}' not found")
             return None
@@ -260,7 +393,7 @@ class GraphAPIClient:
         }
         
         try:
-            response = requests.get(url, headers=self._get_headers(), params=params)
+            response = self._request('GET', url, params=params)
             response.raise_for_status()
             messages = response.json()['value']
             logger.info(f"Retrieved {len(messages)} messages from folder")
@@ -270,11 +403,11 @@ class GraphAPIClient:
             raise
     
     def get_attachments(self, message_id: str) -> List[Dict]:
-        """Get all attachments from a message"""
+        """Get the attachment metadata of a message (content is fetched separately)"""
         url = f'{self.graph_endpoint}/me/messages/{message_id}/attachments'
         
         try:
-            response = requests.get(url, headers=self._get_headers())
+            response = self._request('GET', url, params={'$select': ATTACHMENT_SELECT})
             response.raise_for_status()
             attachments = response.json()['value']
             logger.info(f"Retrieved {len(attachments)} attachments for message {message_id}")
@@ -283,6 +416,63 @@ class GraphAPIClient:
             logger.error(f"Error retrieving attachments: {e}")
             return []
     
+    def get_attachment_content(self, message_id: str, attachment_id: str) -> IO[bytes]:
+        """Stream the raw bytes of a file attachment into a spooled temporary file"""
+        url = f'{self.graph_endpoint}/me/messages/{message_id}/attachments/{attachment_id}/$value'
+        file_obj = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_SIZE)
+        
+        try:
+            with self._request('GET', url, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(ATTACHMENT_CHUNK_SIZE):
+                    file_obj.write(chunk)
+            file_obj.seek(0)
+            return file_obj
+        except Exception as e:
+            file_obj.close()
+            logger.error(f"Error downloading attachment {attachment_id}: {e}")
+            raise
+    
+    def batch(self, requests_list: List[Dict]) -> Dict[str, Dict]:
+        """Send requests through the Graph $batch endpoint, returning responses keyed by id
+        
+        Each request needs 'id', 'method' and 'url' (relative to the API version).
+        Requests are sent in chunks of GRAPH_BATCH_LIMIT.
+        """
+        url = f'{self.graph_endpoint}/$batch'
+        responses = {}
+        
+        try:
+            for start in range(0, len(requests_list), GRAPH_BATCH_LIMIT):
+                chunk = requests_list[start:start + GRAPH_BATCH_LIMIT]
+                response = self._request('POST', url, json={'requests': chunk})
+                response.raise_for_status()
+                for item in response.json()['responses']:
+                    responses[item['id']] = item
+            return responses
+        except Exception as e:
+            logger.error(f"Error sending batch request: {e}")
+            raise
+    
+    def get_attachments_batch(self, message_ids: List[str]) -> Dict[str, List[Dict]]:
+        """Get the attachment metadata of several messages with batched requests"""
+        responses = self.batch([
+            {'id': str(i), 'method': 'GET',
+             'url': f'/me/messages/{message_id}/attachments?$select={ATTACHMENT_SELECT}'}
+            for i, message_id in enumerate(message_ids)
+        ])
+        
+        attachments = {}
+        for i, message_id in enumerate(message_ids):
+            item = responses.get(str(i), {})
+            if item.get('status') == 200:
+                attachments[message_id] = item['body'].get('value', [])
+                logger.info(f"Retrieved {len(attachments[message_id])} attachments for message {message_id}")
+            else:
+                logger.error(f"Error retrieving attachments for message {message_id}: {item.get('body')}")
+                attachments[message_id] = []
+        return attachments
+    
     def send_email(self, to_email: str, subject: str, html_body: str):
         """Send an email using Microsoft Graph API"""
         url = f'{self.graph_endpoint}/me/sendMail'
@@ -306,23 +496,25 @@ class GraphAPIClient:
         }
         
         try:
-            response = requests.post(url, headers=self._get_headers(), json=message)
+            response = self._request('POST', url, json=message)
             response.raise_for_status()
             logger.info(f"Email sent successfully to {to_email}")
         except Exception as e:
             logger.error(f"Error sending email: {e}")
             raise
     
-    def delete_message(self, message_id: str):
-        """Delete a message (move to Deleted Items)"""
+    def delete_message(self, message_id: str) -> bool:
+        """Delete a message (move to Deleted Items), returning whether it worked"""
         url = f'{self.graph_endpoint}/me/messages/{message_id}'
         
         try:
-            response = requests.delete(url, headers=self._get_headers())
+            response = self._request('DELETE', url)
             response.raise_for_status()
             logger.info(f"Message {message_id} deleted successfully")
+            return True
         except Exception as e:
             logger.error(f"Error deleting message: {e}")
+            return False
     
     def move_message(self, message_id: str, destination_folder_id: str):
         """Move a message to another folder"""
@@ -333,18 +525,43 @@ class GraphAPIClient:
         }
         
         try:
-            response = requests.post(url, headers=self._get_headers(), json=data)
+            response = self._request('POST', url, json=data)
             response.raise_for_status()
             logger.info(f"Message {message_id} moved successfully")
         except Exception as e:
             logger.error(f"Error moving message: {e}")
 
 
+class RateLimiter:
+    """Thread-safe token bucket allowing `rate` calls per second"""
+    
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a call is allowed"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 0
+                self.updated = time.monotonic()
+            else:
+                self.tokens -= 1
+
+
 class JiraTicketCreator:
     """Handles JIRA ticket creation and management"""
     
     def __init__(self, jira_url: str, username: str, password: str):
         self.jira = JIRA(server=jira_url, basic_auth=(username, password))
+        # Shared by all JIRA_WORKERS threads, so together they stay under JIRA_RATE_LIMIT
+        self.rate_limiter = RateLimiter(JIRA_RATE_LIMIT)
         logger.info("Connected to JIRA successfully")
     
     def create_ticket(self, summary: str, description: str, project_key: str = 'IAM') -> Any:
@@ -357,6 +574,7 @@ class JiraTicketCreator:
         }
         
         try:
+            self.rate_limiter.acquire()
             issue = self.jira.create_issue(fields=issue_dict)
             logger.info(f"Created JIRA ticket: {issue.key}")
             return issue
@@ -364,38 +582,41 @@ class JiraTicketCreator:
             logger.error(f"Error creating JIRA ticket: {e}")
             raise
     
-    def add_attachment(self, issue_key: str, filename: str, file_content: bytes):
-        """Add an attachment to a JIRA ticket"""
+    def add_attachment(self, issue_key: str, filename: str, file_obj: IO[bytes]) -> bool:
+        """Add an attachment to a JIRA ticket from a file-like object, returning whether it worked"""
         try:
-            # Create a file-like object from bytes
-            from io import BytesIO
-            file_obj = BytesIO(file_content)
-            file_obj.name = filename
-            
+            self.rate_limiter.acquire()
             self.jira.add_attachment(issue=issue_key, attachment=file_obj, filename=filename)
             logger.info(f"Added attachment {filename} to {issue_key}")
+            return True
         except Exception as e:
             logger.error(f"Error adding attachment {filename}: {e}")
+            return False
 
 
 def extract_email_body(email_message: Dict) -> str:
-    """Extract plain text body from email message"""
+    """Extract the email body as JIRA markup"""
     body = email_message.get('body', {})
     content = body.get('content', '')
     content_type = body.get('contentType', 'text')
     
-    # JIRA supports some HTML, but let's keep it clean
+    # JIRA does not render HTML in descriptions - convert it to wiki markup
     if content_type == 'html':
-        # For better HTML parsing, you could use BeautifulSoup
-        # For now, return as-is
-        return content
+        return html_to_jira_markup(content)
     
     return content
 
 
 def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketCreator, 
-                          email_message: Dict):
-    """Process a single email and create a JIRA ticket"""
+                          email_message: Dict, attachments: Optional[List[Dict]] = None) -> bool:
+    """Process a single email and create a JIRA ticket
+    
+    attachments may be prefetched with get_attachments_batch; otherwise they
+    are fetched here when the message has any.
+    
+    The email is deleted as soon as its ticket and confirmation are done, so
+    a crash later in the run cannot make the next run ticket it again.
+    """
     
     try:
         # Extract email details
@@ -430,16 +651,28 @@ def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketC
         
         # Get and attach files
         if email_message.get('hasAttachments'):
-            attachments = graph_client.get_attachments(message_id)
+            if attachments is None:
+                attachments = graph_client.get_attachments(message_id)
+            attached = True
             for attachment in attachments:
                 if attachment.get('@odata.type') == '#microsoft.graph.fileAttachment':
                     filename = attachment['name']
-                    content_bytes = base64.b64decode(attachment['contentBytes'])
-                    jira_client.add_attachment(jira_issue.key, filename, content_bytes)
+                    try:
+                        file_obj = graph_client.get_attachment_content(message_id, attachment['id'])
+                    except Exception:
+                        # Already logged - try the other files, but keep the email
+                        attached = False
+                        continue
+                    with file_obj:
+                        attached = jira_client.add_attachment(jira_issue.key, filename, file_obj) and attached
+            
+            if not attached:
+                # Neither reply nor delete, so the attachments are not lost with the email
+                logger.error(f"Ticket {jira_issue.key} is missing attachments, keeping email {message_id}")
+                return False
         
         # Send confirmation email
-        template = Template(EMAIL_TEMPLATE)
-        html_body = template.render(
+        html_body = CONFIRMATION_TEMPLATE.render(
             sender_name=sender_name,
             ticket_key=jira_issue.key,
             ticket_summary=subject,
@@ -453,7 +686,7 @@ def process_email_to_jira(graph_client: GraphAPIClient, jira_client: JiraTicketC
             html_body=html_body
         )
         
-        # Delete the processed email from the folder
+        # Delete the processed email right away
         graph_client.delete_message(message_id)
         
         logger.info(f"Successfully processed email and created ticket {jira_issue.key}")
@@ -472,36 +705,50 @@ def main():
     
     try:
         # Initialize clients
-        graph_client = GraphAPIClient(
+        with GraphAPIClient(
             tenant_id=TENANT_ID,
             client_id=CLIENT_ID,
             client_secret=CLIENT_SECRET,
             username=MAILBOX_USER,
             password=MAILBOX_PASSWORD
-        )
-        
-        jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
-        
-        # Get folder ID
-        folder_id = graph_client.get_folder_id(FOLDER_NAME)
-        if not folder_id:
-            logger.error(f"Could not find folder '{FOLDER_NAME}'")
-            return
-        
-        # Get messages
-        messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
-        
-        if not messages:
-            logger.info("No messages to process")
-            return
-        
-        # Process each message
-        success_count = 0
-        for message in messages:
-            if process_email_to_jira(graph_client, jira_client, message):
-                success_count += 1
-        
-        logger.info(f"Processed {success_count}/{len(messages)} emails successfully")
+        ) as graph_client:
+            
+            jira_client = JiraTicketCreator(JIRA_URL, JIRA_USER, JIRA_PASSWORD)
+            
+            # Get folder ID
+            folder_id = graph_client.get_folder_id(FOLDER_NAME)
+            if not folder_id:
+                logger.error(f"Could not find folder '{FOLDER_NAME}'")
+                return
+            
+            # Get messages
+            messages = graph_client.get_messages_from_folder(folder_id, BATCH_SIZE)
+            
+            if not messages:
+                logger.info("No messages to process")
+                return
+            
+            # Fetch attachments for all messages that have them in batched requests
+            attachment_map = graph_client.get_attachments_batch(
+                [message['id'] for message in messages if message.get('hasAttachments')]
+            )
+            
+            # Process messages in parallel - the work is network bound
+            processed = 0
+            with ThreadPoolExecutor(max_workers=JIRA_WORKERS) as executor:
+                futures = {
+                    executor.submit(process_email_to_jira, graph_client, jira_client,
+                                    message, attachment_map.get(message['id'])): message['id']
+                    for message in messages
+                }
+                for future in as_completed(futures):
+                    try:
+                        if future.result():
+                            processed += 1
+                    except Exception as e:
+                        logger.error(f"Error processing email {futures[future]}: {e}", exc_info=True)
+            
+            logger.info(f"Processed {processed}/{len(messages)} emails successfully")
         
     except Exception as e:
         logger.error(f"Fatal error in main execution: {e}", exc_info=True)
@@ -1,6 +1,176 @@
 from bs4 import BeautifulSoup, NavigableString, Comment
 import re
 
+# Parse with lxml's C parser when it is installed, the pure-Python one otherwise
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+RE_EXCESS_NEWLINES = re.compile(r'\n{3,}')
+
+
+def _blockquote(element, content):
+    """Prefix each non-empty line of a blockquote with bq."""
+    lines = [f'bq. {line.strip()}\n' for line in content.strip().split('\n') if line.strip()]
+    return ''.join(lines) + '\n'
+
+
+def _link(element, content):
+    href = element.get('href', '')
+    if href:
+        return f'[{content.strip()}|{href}]'
+    return content
+
+
+def _image(element, list_level):
+    src = element.get('src', '')
+    return f'!{src}!' if src else ''
+
+
+def _list(marker):
+    def convert(element, list_level):
+        return ''.join(_process_list_item(child, marker, list_level)
+                       for child in element.children if child.name == 'li')
+    return convert
+
+
+# Tags whose markup wraps the converted children: tag -> (element, content) -> str
+WRAP_TAGS = {
+    'b': lambda element, content: f'*{content}*',
+    'strong': lambda element, content: f'*{content}*',
+    'i': lambda element, content: f'_{content}_',
+    'em': lambda element, content: f'_{content}_',
+    'u': lambda element, content: f'+{content}+',
+    's': lambda element, content: f'-{content}-',
+    'strike': lambda element, content: f'-{content}-',
+    'del': lambda element, content: f'-{content}-',
+    'code': lambda element, content: f'{{{content}}}',
+    'a': _link,
+    'p': lambda element, content: f'{content.strip()}\n\n',
+    'blockquote': _blockquote,
+}
+WRAP_TAGS.update({
+    f'h{level}': (lambda element, content, level=level: f'h{level}. {content.strip()}\n\n')
+    for level in range(1, 7)
+})
+
+# Tags converted as a whole without walking their children: tag -> (element, list_level) -> str
+LEAF_TAGS = {
+    'pre': lambda element, list_level: f'{{code}}\n{element.get_text()}\n{{code}}\n\n',
+    'img': _image,
+    'br': lambda element, list_level: '\n',
+    'hr': lambda element, list_level: '----\n\n',
+    'ul': _list('*'),
+    'ol': _list('#'),
+    'table': lambda element, list_level: _process_table(element),
+}
+
+
+def _process_element(root, list_level=0):
+    """Convert an element and its descendants to JIRA markup.
+    
+    Walks the tree with an explicit stack instead of recursion. Each wrapping
+    tag pushes an exit entry holding the output position where its children
+    start; on exit those pieces are joined and replaced by the wrapped markup.
+    """
+    out = []
+    stack = [(root, list_level, None)]
+    
+    while stack:
+        element, level, start = stack.pop()
+        
+        if start is not None:
+            content = ''.join(out[start:])
+            del out[start:]
+            out.append(WRAP_TAGS[element.name](element, content))
+            continue
+        
+        if isinstance(element, NavigableString):
+            text = str(element)
+            # Preserve whitespace but drop whitespace-only nodes
+            if text.strip():
+                out.append(text)
+            continue
+        
+        tag = element.name
+        leaf = LEAF_TAGS.get(tag)
+        if leaf is not None:
+            out.append(leaf(element, level))
+            continue
+        
+        if tag in WRAP_TAGS:
+            stack.append((element, level, len(out)))
+            # Inline formatting starts a fresh list context
+            level = 0
+        
+        # Divs, spans and any other element - just process children
+        stack.extend((child, level, None) for child in reversed(element.contents))
+    
+    return ''.join(out)
+
+
+def _process_list_item(li, marker, level):
+    """Process list item with proper nesting."""
+    prefix = marker * (level + 1)
+    content_parts = []
+    
+    for child in li.children:
+        if child.name in ['ul', 'ol']:
+            # Nested list
+            new_marker = '*' if child.name == 'ul' else '#'
+            for nested_li in child.find_all('li', recursive=False):
+                content_parts.append('\n' + _process_list_item(nested_li, new_marker, level + 1))
+        else:
+            content_parts.append(_process_element(child, level))
+    
+    content = ''.join(content_parts).strip()
+    return f'{prefix} {content}\n'
+
+
+def _table_row(tr, separator):
+    """Convert one table row, or return None when it has no cells."""
+    cells = [_process_element(cell).strip() for cell in tr.find_all(['td', 'th'])]
+    if not cells:
+        return None
+    return separator + separator.join(cells) + separator
+
+
+def _process_table(table):
+    """Convert HTML table to JIRA table markup.
+    
+    Rows of a table nested in a cell are listed again under every
+    thead/tbody that contains them, as the multi-pass version did.
+    """
+    sections = {'thead': [], 'tbody': []}
+    section_rows = {}
+    bare = []
+    
+    # Collect the sections, in document order, and their rows in a single walk of the table
+    for element in table.find_all(['thead', 'tbody', 'tr']):
+        if element.name != 'tr':
+            section_rows[id(element)] = []
+            sections[element.name].append(section_rows[id(element)])
+            continue
+        if element.parent is table:
+            bare.append(element)
+        for parent in element.parents:
+            if parent is table:
+                break
+            if id(parent) in section_rows:
+                section_rows[id(parent)].append(element)
+    
+    rows = ([_table_row(tr, '||') for head in sections['thead'] for tr in head]
+            + [_table_row(tr, '|') for body in sections['tbody'] for tr in body])
+    
+    # If no thead/tbody, just process the table's own rows
+    if not any(rows):
+        rows = [_table_row(tr, '||' if tr.find('th') else '|') for tr in bare]
+    
+    rows = [row for row in rows if row]
+    return '\n'.join(rows) + '\n\n' if rows else ''
+
 
 def html_to_jira_markup(html_content: str) -> str:
     """
@@ -12,188 +182,17 @@ def html_to_jira_markup(html_content: str) -> str:
     Returns:
         JIRA-formatted markup string
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
+    soup = BeautifulSoup(html_content, HTML_PARSER)
     
     # Remove all HTML comments
-    from bs4 import Comment
     for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
         comment.extract()
     
-    def process_element(element, list_type=None, list_level=0):
-        """Recursively process HTML elements and convert to JIRA markup."""
-        if isinstance(element, NavigableString):
-            text = str(element)
-            # Preserve whitespace but clean up excessive newlines
-            if text.strip():
-                return text
-            return ''
-        
-        result = []
-        tag = element.name
-        
-        # Headers
-        if tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-            level = tag[1]
-            content = ''.join(process_element(child) for child in element.children)
-            result.append(f'h{level}. {content.strip()}\n\n')
-        
-        # Bold
-        elif tag in ['b', 'strong']:
-            content = ''.join(process_element(child) for child in element.children)
-            result.append(f'*{content}*')
-        
-        # Italic
-        elif tag in ['i', 'em']:
-            content = ''.join(process_element(child) for child in element.children)
-            result.append(f'_{content}_')
-        
-        # Underline
-        elif tag == 'u':
-            content = ''.join(process_element(child) for child in element.children)
-            result.append(f'+{content}+')
-        
-        # Strikethrough
-        elif tag in ['s', 'strike', 'del']:
-            content = ''.join(process_element(child) for child in element.children)
-            result.append(f'-{content}-')
-        
-        # Code
-        elif tag == 'code':
-            content = ''.join(process_element(child) for child in element.children)
-            result.append(f'{{{content}}}')
-        
-        # Preformatted/Code blocks
-        elif tag == 'pre':
-            content = element.get_text()
-            result.append(f'{{code}}\n{content}\n{{code}}\n\n')
-        
-        # Links
-        elif tag == 'a':
-            href = element.get('href', '')
-            content = ''.join(process_element(child) for child in element.children)
-            if href:
-                result.append(f'[{content.strip()}|{href}]')
-            else:
-                result.append(content)
-        
-        # Images
-        elif tag == 'img':
-            src = element.get('src', '')
-            alt = element.get('alt', '')
-            if src:
-                result.append(f'!{src}!')
-        
-        # Paragraphs
-        elif tag == 'p':
-            content = ''.join(process_element(child) for child in element.children)
-            result.append(f'{content.strip()}\n\n')
-        
-        # Line breaks
-        elif tag == 'br':
-            result.append('\n')
-        
-        # Horizontal rule
-        elif tag == 'hr':
-            result.append('----\n\n')
-        
-        # Blockquote
-        elif tag == 'blockquote':
-            content = ''.join(process_element(child) for child in element.children)
-            lines = content.strip().split('\n')
-            for line in lines:
-                if line.strip():
-                    result.append(f'bq. {line.strip()}\n')
-            result.append('\n')
-        
-        # Lists
-        elif tag == 'ul':
-            for child in element.children:
-                if child.name == 'li':
-                    result.append(process_list_item(child, '*', list_level))
-        
-        elif tag == 'ol':
-            for child in element.children:
-                if child.name == 'li':
-                    result.append(process_list_item(child, '#', list_level))
-        
-        # Tables
-        elif tag == 'table':
-            result.append(process_table(element))
-        
-        # Divs and spans - process children
-        elif tag in ['div', 'span', 'body', 'html']:
-            for child in element.children:
-                result.append(process_element(child, list_type, list_level))
-        
-        # Other elements - just process children
-        else:
-            for child in element.children:
-                result.append(process_element(child, list_type, list_level))
-        
-        return ''.join(result)
-    
-    def process_list_item(li, marker, level):
-        """Process list item with proper nesting."""
-        prefix = marker * (level + 1)
-        content_parts = []
-        
-        for child in li.children:
-            if child.name in ['ul', 'ol']:
-                # Nested list
-                new_marker = '*' if child.name == 'ul' else '#'
-                for nested_li in child.find_all('li', recursive=False):
-                    content_parts.append('\n' + process_list_item(nested_li, new_marker, level + 1))
-            else:
-                content_parts.append(process_element(child, marker, level))
-        
-        content = ''.join(content_parts).strip()
-        return f'{prefix} {content}\n'
-    
-    def process_table(table):
-        """Convert HTML table to JIRA table markup."""
-        rows = []
-        
-        # Process header rows
-        for thead in table.find_all('thead'):
-            for tr in thead.find_all('tr'):
-                cells = []
-                for th in tr.find_all(['th', 'td']):
-                    content = ''.join(process_element(child) for child in th.children).strip()
-                    cells.append(content)
-                if cells:
-                    rows.append('||' + '||'.join(cells) + '||')
-        
-        # Process body rows
-        for tbody in table.find_all('tbody'):
-            for tr in tbody.find_all('tr'):
-                cells = []
-                for td in tr.find_all(['td', 'th']):
-                    content = ''.join(process_element(child) for child in td.children).strip()
-                    cells.append(content)
-                if cells:
-                    rows.append('|' + '|'.join(cells) + '|')
-        
-        # If no thead/tbody, just process all rows
-        if not rows:
-            for tr in table.find_all('tr', recursive=False):
-                cells = []
-                has_th = bool(tr.find('th'))
-                for cell in tr.find_all(['td', 'th']):
-                    content = ''.join(process_element(child) for child in cell.children).strip()
-                    cells.append(content)
-                if cells:
-                    if has_th:
-                        rows.append('||' + '||'.join(cells) + '||')
-                    else:
-                        rows.append('|' + '|'.join(cells) + '|')
-        
-        return '\n'.join(rows) + '\n\n' if rows else ''
-    
     # Process the HTML
-    jira_markup = process_element(soup)
+    jira_markup = _process_element(soup)
     
     # Clean up excessive newlines (more than 2 consecutive)
-    jira_markup = re.sub(r'\n{3,}', '\n\n', jira_markup)
+    jira_markup = RE_EXCESS_NEWLINES.sub('\n\n', jira_markup)
     
     return jira_markup.strip()
 
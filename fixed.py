@@ -5,10 +5,53 @@ This script demonstrates how to authenticate and access your Exchange Online mai
 using the Microsoft Graph API with username/password authentication.
 """
 
+import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 from datetime import datetime
-import urllib.parse
+import msal
+
+from token_cache import TOKEN_CACHE_FILE
+
+# Use orjson for Graph payloads when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# Delegated scopes; MSAL adds offline_access itself so a refresh token is issued
+GRAPH_SCOPES = [
+    "https://graph.microsoft.com/Mail.ReadWrite",
+    "https://graph.microsoft.com/Mail.Send",
+    "https://graph.microsoft.com/User.Read"
+]
+DEFAULT_SCOPES = ["https://graph.microsoft.com/.default"]
+
+# Sign-in errors that a different scope cannot fix: consent, MFA, unknown user, bad password
+PERMANENT_AUTH_ERRORS = ('AADSTS65001', 'AADSTS50076', 'AADSTS50034', 'AADSTS50126')
+
+# Message fields shown by the listings; bodyPreview is by far the largest
+ENVELOPE_SELECT = "subject,from,receivedDateTime,isRead"
+MESSAGE_SELECT = ENVELOPE_SELECT + ",bodyPreview"
+SEARCH_SELECT = "subject,from,receivedDateTime,bodyPreview"
+
+class PostSafeRetry(Retry):
+    """
+    Retry that only repeats a POST the server turned away
+    
+    Graph can answer a POST (sendMail, $batch) with a 5xx after it has already
+    acted on it, so a POST is only retried on 429/503 carrying Retry-After.
+    """
+    
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return bool(self.total) and has_retry_after and status_code in (429, 503)
+        return super().is_retry(method, status_code, has_retry_after)
 
 class ExchangeGraphClient:
     def __init__(self, tenant_id, client_id, username, password):
@@ -28,94 +71,130 @@ class ExchangeGraphClient:
         self.access_token = None
         self.graph_endpoint = "https://graph.microsoft.com/v1.0"
         
+        # One keep-alive session for the token endpoint and Graph, retrying
+        # throttled (429) and transient server errors (POSTs only when turned away)
+        self._session = requests.Session()
+        retry = PostSafeRetry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset(['GET', 'PATCH', 'DELETE']),
+            raise_on_status=False
+        )
+        self._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+        
+        # Public client for the ROPC flow, backed by a token cache persisted across runs
+        self._cache = msal.SerializableTokenCache()
+        if os.path.exists(TOKEN_CACHE_FILE):
+            with open(TOKEN_CACHE_FILE) as f:
+                self._cache.deserialize(f.read())
+        self.app = msal.PublicClientApplication(
+            client_id,
+            authority=f"https://login.microsoftonline.com/{tenant_id}",
+            token_cache=self._cache,
+            http_client=self._session
+        )
+    
+    def close(self):
+        """Release pooled connections"""
+        self._session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def _save_cache(self):
+        """
+        Write the MSAL token cache back to disk if it changed
+        """
+        if not self._cache.has_state_changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(TOKEN_CACHE_FILE), exist_ok=True)
+            # Cache holds refresh tokens - keep it readable by the owner only
+            fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self._cache.serialize())
+        except OSError as e:
+            print(f"⚠️  Could not cache access token: {e}")
+    
     def authenticate(self):
         """
         Authenticate using Resource Owner Password Credentials (ROPC) flow
         Note: This requires specific Azure AD configuration
-        """
-        auth_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
-        
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-        
-        # Try with specific scopes first
-        data = {
-            'client_id': self.client_id,
-            'scope': 'https://graph.microsoft.com/Mail.ReadWrite https://graph.microsoft.com/Mail.Send https://graph.microsoft.com/User.Read',
-            'username': self.username,
-            'password': self.password,
-            'grant_type': 'password'
-        }
         
+        MSAL serves a cached token, or refreshes it, before the password flow
+        is used; its cache is kept on disk between runs.
+        """
         try:
-            response = requests.post(auth_url, headers=headers, data=data)
+            # Try cached token / refresh token first
+            accounts = self.app.get_accounts(username=self.username)
+            if accounts:
+                result = self.app.acquire_token_silent(GRAPH_SCOPES, account=accounts[0])
+                if result and 'access_token' in result:
+                    self.access_token = result['access_token']
+                    self._save_cache()
+                    print("✅ Using cached access token")
+                    return True
+            
+            # Try with specific scopes first
+            result = self.app.acquire_token_by_username_password(
+                self.username, self.password, scopes=GRAPH_SCOPES
+            )
             
-            if response.status_code == 400:
+            error_description = result.get('error_description', '')
+            if 'access_token' not in result and not any(code in error_description for code in PERMANENT_AUTH_ERRORS):
                 # If specific scopes fail, try with .default scope
                 print("🔄 Trying alternative authentication method...")
-                data['scope'] = 'https://graph.microsoft.com/.default'
-                response = requests.post(auth_url, headers=headers, data=data)
-            
-            if response.status_code == 400:
-                # Parse the error response
-                error_data = response.json()
-                error_code = error_data.get('error', '')
-                error_description = error_data.get('error_description', '')
-                
-                if 'AADSTS65001' in error_description:
-                    print("❌ Consent Required Error:")
-                    print("   The application needs admin consent for the requested permissions.")
-                    print("   Please follow these steps:")
-                    print("   1. Go to Azure Portal > Azure Active Directory > App registrations")
-                    print("   2. Find your application and go to 'API permissions'")
-                    print("   3. Click 'Grant admin consent for [your organization]'")
-                    print("   4. Alternatively, use the admin consent URL below:")
-                    admin_consent_url = f"https://login.microsoftonline.com/{self.tenant_id}/adminconsent?client_id={self.client_id}"
-                    print(f"   {admin_consent_url}")
-                    return False
-                elif 'AADSTS50076' in error_description:
-                    print("❌ MFA Required:")
-                    print("   Multi-factor authentication is required but not supported with password flow.")
-                    print("   Please disable MFA for this account or use interactive authentication.")
-                    return False
-                elif 'AADSTS50034' in error_description:
-                    print("❌ User Not Found:")
-                    print("   The username doesn't exist in this tenant.")
-                    return False
-                elif 'AADSTS50126' in error_description:
-                    print("❌ Invalid Credentials:")
-                    print("   Username or password is incorrect.")
-                    return False
-                else:
-                    print(f"❌ Authentication error: {error_code}")
-                    print(f"   Description: {error_description}")
-                    return False
-            
-            response.raise_for_status()
-            token_data = response.json()
-            self.access_token = token_data.get('access_token')
-            
-            if self.access_token:
-                print("✅ Authentication successful!")
-                return True
-            else:
-                print("❌ Authentication failed: No access token received")
-                return False
-                
+                result = self.app.acquire_token_by_username_password(
+                    self.username, self.password, scopes=DEFAULT_SCOPES
+                )
+        
         except requests.exceptions.RequestException as e:
             print(f"❌ Authentication error: {e}")
-            if hasattr(e, 'response') and e.response and e.response.text:
-                try:
-                    error_data = e.response.json()
-                    print(f"Error details: {error_data}")
-                except:
-                    print(f"Response: {e.response.text}")
             return False
+        
+        if 'access_token' in result:
+            self.access_token = result['access_token']
+            self._save_cache()
+            print("✅ Authentication successful!")
+            return True
+        
+        error_code = result.get('error', '')
+        error_description = result.get('error_description', '')
+        
+        if 'AADSTS65001' in error_description:
+            print("❌ Consent Required Error:")
+            print("   The application needs admin consent for the requested permissions.")
+            print("   Please follow these steps:")
+            print("   1. Go to Azure Portal > Azure Active Directory > App registrations")
+            print("   2. Find your application and go to 'API permissions'")
+            print("   3. Click 'Grant admin consent for [your organization]'")
+            print("   4. Alternatively, use the admin consent URL below:")
+            admin_consent_url = f"https://login.microsoftonline.com/{self.tenant_id}/adminconsent?client_id={self.client_id}"
+            print(f"   {admin_consent_url}")
+        elif 'AADSTS50076' in error_description:
+            print("❌ MFA Required:")
+            print("   Multi-factor authentication is required but not supported with password flow.")
+            print("   Please disable MFA for this account or use interactive authentication.")
+        elif 'AADSTS50034' in error_description:
+            print("❌ User Not Found:")
+            print("   The username doesn't exist in this tenant.")
+        elif 'AADSTS50126' in error_description:
+            print("❌ Invalid Credentials:")
+            print("   Username or password is incorrect.")
+        else:
+            print(f"❌ Authentication error: {error_code}")
+            print(f"   Description: {error_description}")
+        return False
     
-    def _make_request(self, endpoint, method='GET', data=None):
+    def _make_request(self, endpoint, method='GET', data=None, params=None):
         """
         Make an authenticated request to the Graph API
+        
+        Query parameters passed in params are encoded by requests.
         """
         if not self.access_token:
             print("❌ No access token. Please authenticate first.")
@@ -126,22 +205,23 @@ class ExchangeGraphClient:
             'Content-Type': 'application/json'
         }
         
-        url = f"{self.graph_endpoint}{endpoint}"
+        # Paging and delta links come back as absolute URLs
+        url = endpoint if endpoint.startswith('https://') else f"{self.graph_endpoint}{endpoint}"
         
         try:
             if method == 'GET':
-                response = requests.get(url, headers=headers)
+                response = self._session.get(url, headers=headers, params=params)
             elif method == 'POST':
-                response = requests.post(url, headers=headers, json=data)
+                response = self._session.post(url, headers=headers, data=json_dumps(data))
             elif method == 'PATCH':
-                response = requests.patch(url, headers=headers, json=data)
+                response = self._session.patch(url, headers=headers, data=json_dumps(data))
             elif method == 'DELETE':
-                response = requests.delete(url, headers=headers)
+                response = self._session.delete(url, headers=headers)
                 
             response.raise_for_status()
             
             if response.content:
-                return response.json()
+                return json_loads(response.content)
             return True
             
         except requests.exceptions.RequestException as e:
@@ -150,48 +230,172 @@ class ExchangeGraphClient:
                 print(f"Response: {e.response.text}")
             return None
     
+    def batch(self, requests_list):
+        """
+        Send several GET requests in one call to the Graph $batch endpoint
+        
+        Args:
+            requests_list (list): (id, endpoint) pairs, endpoints relative to the API version
+        
+        Returns:
+            dict: Response body per id (None for failed requests), or None if the batch failed
+        """
+        body = {
+            "requests": [
+                {"id": request_id, "method": "GET", "url": endpoint}
+                for request_id, endpoint in requests_list
+            ]
+        }
+        result = self._make_request("/$batch", method='POST', data=body)
+        if not result:
+            return None
+        
+        responses = {}
+        for item in result.get('responses', []):
+            if item.get('status') == 200:
+                responses[item['id']] = item.get('body')
+            else:
+                print(f"❌ Batched request {item['id']} failed: {item.get('body')}")
+                responses[item['id']] = None
+        return responses
+    
+    def get_overview(self, top=5):
+        """
+        Get the user profile, mailbox folders and latest inbox messages in one round trip
+        
+        Args:
+            top (int): Number of inbox messages to retrieve
+        """
+        print("📋 Fetching profile, folders and messages...")
+        responses = self.batch([
+            ('profile', "/me"),
+            ('folders', "/me/mailFolders"),
+            ('messages', self._messages_endpoint('inbox', top)),
+        ])
+        if responses is None:
+            return None
+        
+        self._show_profile(responses.get('profile'))
+        print("\n" + "="*40)
+        self._show_folders(responses.get('folders'))
+        print("\n" + "="*40)
+        self._show_messages(responses.get('messages'))
+        return responses
+    
     def get_user_profile(self):
         """Get the current user's profile information"""
         print("📋 Fetching user profile...")
         result = self._make_request("/me")
-        
+        self._show_profile(result)
+        return result
+    
+    @staticmethod
+    def _show_profile(result):
+        """Print a user profile"""
         if result:
             print(f"Name: {result.get('displayName')}")
             print(f"Email: {result.get('mail')}")
             print(f"Job Title: {result.get('jobTitle', 'N/A')}")
             print(f"Office Location: {result.get('officeLocation', 'N/A')}")
-        
-        return result
     
     def get_mailbox_folders(self):
         """Get all mailbox folders"""
         print("📁 Fetching mailbox folders...")
         result = self._make_request("/me/mailFolders")
-        
+        self._show_folders(result)
+        return result
+    
+    @staticmethod
+    def _show_folders(result):
+        """Print a mailFolders listing"""
         if result and 'value' in result:
             folders = result['value']
             print(f"Found {len(folders)} folders:")
             for folder in folders:
                 print(f"  - {folder['displayName']} ({folder['totalItemCount']} items)")
-        
-        return result
     
-    def get_messages(self, folder_id='inbox', top=10):
+    @staticmethod
+    def _messages_endpoint(folder_id, top, include_preview=True):
+        """Build the messages endpoint for a folder"""
+        endpoint = f"/me/mailFolders/{folder_id}/messages"
+        if top:
+            select = MESSAGE_SELECT if include_preview else ENVELOPE_SELECT
+            endpoint += f"?$top={top}&$select={select}"
+        return endpoint
+    
+    def get_messages(self, folder_id='inbox', top=10, include_preview=False):
         """
         Get messages from a specific folder
         
         Args:
             folder_id (str): Folder ID or name ('inbox', 'sentitems', etc.)
             top (int): Number of messages to retrieve
+            include_preview (bool): Also fetch and show each message's bodyPreview
         """
         print(f"📧 Fetching {top} messages from {folder_id}...")
         
-        endpoint = f"/me/mailFolders/{folder_id}/messages"
-        if top:
-            endpoint += f"?$top={top}&$select=subject,from,receivedDateTime,isRead,bodyPreview"
+        result = self._make_request(self._messages_endpoint(folder_id, top, include_preview))
+        self._show_messages(result)
+        return result
+    
+    def get_messages_delta(self, folder_id='inbox'):
+        """
+        Get the messages added or changed in a folder since the previous call
+        
+        The first call pages through the whole folder. Graph's deltaLink is then
+        kept in ~/.cache/mbxj, so later calls (also from later runs) only
+        transfer the changes.
+        
+        Args:
+            folder_id (str): Folder ID or name ('inbox', 'sentitems', etc.)
+        """
+        print(f"📧 Fetching changed messages from {folder_id}...")
+        
+        state_file = os.path.join(os.path.dirname(TOKEN_CACHE_FILE), f"delta-{folder_id}.json")
+        delta_link = None
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+            if state.get('key') == [self.tenant_id, self.username]:
+                delta_link = state.get('deltaLink')
+        except (OSError, ValueError):
+            pass
+        
+        full_query = f"/me/mailFolders/{folder_id}/messages/delta?$select={MESSAGE_SELECT}"
+        endpoint = delta_link or full_query
+        messages = []
+        
+        while endpoint:
+            result = self._make_request(endpoint)
+            if result is None:
+                if delta_link and endpoint == delta_link:
+                    # Expired or invalid link (410 Gone) - start over with a full sync
+                    print("🔄 Delta link no longer valid, fetching the whole folder...")
+                    endpoint = full_query
+                    delta_link = None
+                    messages = []
+                    continue
+                return None
             
-        result = self._make_request(endpoint)
+            # Deleted messages are reported as '@removed' entries
+            messages.extend(msg for msg in result.get('value', []) if '@removed' not in msg)
+            endpoint = result.get('@odata.nextLink')
+            delta_link = result.get('@odata.deltaLink', delta_link)
         
+        try:
+            os.makedirs(os.path.dirname(state_file), exist_ok=True)
+            with open(state_file, 'w') as f:
+                json.dump({'key': [self.tenant_id, self.username], 'deltaLink': delta_link}, f)
+        except OSError as e:
+            print(f"⚠️  Could not save delta link: {e}")
+        
+        result = {'value': messages}
+        self._show_messages(result)
+        return result
+    
+    @staticmethod
+    def _show_messages(result):
+        """Print a messages listing"""
         if result and 'value' in result:
             messages = result['value']
             print(f"Found {len(messages)} messages:")
@@ -208,9 +412,8 @@ class ExchangeGraphClient:
                 print(f"\n{i}. {status} From: {from_addr}")
                 print(f"   Subject: {subject}")
                 print(f"   Received: {received}")
-                print(f"   Preview: {preview}")
-        
-        return result
+                if 'bodyPreview' in msg:
+                    print(f"   Preview: {preview}")
     
     def search_messages(self, query, top=10):
         """
@@ -222,10 +425,12 @@ class ExchangeGraphClient:
         """
         print(f"🔍 Searching for messages with query: '{query}'...")
         
-        encoded_query = urllib.parse.quote(query)
-        endpoint = f"/me/messages?$search=\"{encoded_query}\"&$top={top}&$select=subject,from,receivedDateTime,bodyPreview"
-        
-        result = self._make_request(endpoint)
+        params = {
+            '$search': f'"{query}"',
+            '$top': top,
+            '$select': SEARCH_SELECT
+        }
+        result = self._make_request("/me/messages", params=params)
         
         if result and 'value' in result:
             messages = result['value']
@@ -308,20 +513,13 @@ def main():
     # Authenticate
     if not client.authenticate():
         print("❌ Authentication failed. Please check your credentials.")
+        client.close()
         return
     
     try:
-        # Get user profile
-        print("\n" + "="*40)
-        client.get_user_profile()
-        
-        # Get mailbox folders
-        print("\n" + "="*40)
-        client.get_mailbox_folders()
-        
-        # Get recent messages from inbox
+        # Get user profile, mailbox folders and recent inbox messages in one batch
         print("\n" + "="*40)
-        client.get_messages('inbox', top=5)
+        client.get_overview(top=5)
         
         # Example: Search for messages
         print("\n" + "="*40)
@@ -342,6 +540,8 @@ def main():
         print("\n\n👋 Exiting...")
     except Exception as e:
         print(f"❌ An error occurred: {e}")
+    finally:
+        client.close()
 
 
 if __name__ == "__main__":
@@ -390,8 +590,8 @@ SETUP INSTRUCTIONS:
    - USERNAME: Your email address
    - PASSWORD: Your password
 
-7. Install Required Package:
-   pip install requests
+7. Install Required Packages:
+   pip install requests msal
 
 8. Update the configuration variables in the main() function with your actual values.
 
@@ -417,7 +617,8 @@ IMPORTANT SECURITY NOTES:
 - This flow may be blocked by default in many organizations
 - For production use, consider using more secure flows like Authorization Code flow
 - Never hardcode credentials in production code - use environment variables or secure vaults
-- This script stores credentials in memory only and doesn't persist them
+- This script keeps your password in memory only; MSAL's token cache (access and
+  refresh tokens) is kept in ~/.cache/mbxj/msal_cache.bin (readable by your user only)
 
 TROUBLESHOOTING:
 ===============
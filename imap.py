@@ -17,22 +17,21 @@ def decode_header(header_value):
     if not header_value:
         return ""
     
-    decoded_parts = email.header.decode_header(header_value)
-    decoded_string = ""
+    decoded_parts = []
     
-    for part, encoding in decoded_parts:
+    for part, encoding in email.header.decode_header(header_value):
         if isinstance(part, bytes):
             if encoding:
                 try:
-                    decoded_string += part.decode(encoding)
+                    decoded_parts.append(part.decode(encoding))
+                    continue
                 except (UnicodeDecodeError, LookupError):
-                    decoded_string += part.decode('utf-8', errors='ignore')
-            else:
-                decoded_string += part.decode('utf-8', errors='ignore')
+                    pass
+            decoded_parts.append(part.decode('utf-8', errors='ignore'))
         else:
-            decoded_string += str(part)
+            decoded_parts.append(str(part))
     
-    return decoded_string
+    return ''.join(decoded_parts)
 
 def connect_to_shared_mailbox():
     """
@@ -99,20 +98,32 @@ def connect_to_shared_mailbox():
         # Get the most recent emails (IMAP returns oldest first, so we reverse)
         recent_email_ids = email_ids[-emails_to_read:][::-1]
         
+        # Fetch the headers of all of them in one command - only the headers
+        # we show, and PEEK leaves the \Seen flag alone
+        result, msg_data = mail.fetch(b','.join(recent_email_ids),
+                                      '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])')
+        
+        # The server answers in its own order - index the header blocks by
+        # message number. Each is a (b'<num> (BODY[...] {size}', headers) tuple.
+        headers_by_id = {}
+        if result == 'OK':
+            for item in msg_data:
+                if isinstance(item, tuple):
+                    headers_by_id[item[0].split(None, 1)[0]] = item[1]
+        
         print("Email Subjects:")
         print("-" * 50)
         
         for i, email_id in enumerate(recent_email_ids, 1):
             try:
-                # Fetch email headers only for better performance
-                result, msg_data = mail.fetch(email_id, '(RFC822.HEADER)')
+                header_bytes = headers_by_id.get(email_id)
                 
-                if result != 'OK':
+                if header_bytes is None:
                     print(f"{i:2d}. Error fetching email {email_id.decode()}")
                     continue
                 
                 # Parse email headers
-                email_message = email.message_from_bytes(msg_data[0][1])
+                email_message = email.message_from_bytes(header_bytes)
                 
                 # Get and decode subject
                 subject = email_message.get('Subject', 'No Subject')
@@ -5,18 +5,60 @@ This script demonstrates how to access a specific shared mailbox using Graph API
 with delegated permissions (no admin consent required for broad access).
 """
 
+import os
+import atexit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
-from datetime import datetime, timedelta
-import base64
+import time
+from urllib.parse import quote, urlencode
+from datetime import datetime, timedelta, timezone
 import msal
 import logging
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple, Iterator
+
+from token_cache import TOKEN_CACHE_FILE
+
+# Use orjson for Graph payloads when it is installed
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+GRAPH_BATCH_LIMIT = 20  # Max requests per Graph $batch call
+
+# Well-known folder names Graph accepts in place of a folder ID
+WELL_KNOWN_FOLDERS = frozenset({
+    "inbox", "drafts", "sentitems", "deleteditems", "junkemail", "archive",
+    "outbox", "msgfolderroot", "conversationhistory", "clutter", "scheduled"
+})
+
+# Fields returned by the listings and by get_message_details
+FOLDER_SELECT = "id,displayName,totalItemCount,unreadItemCount"
+MESSAGE_SELECT = "id,subject,sender,receivedDateTime,isRead,hasAttachments,bodyPreview"
+MESSAGE_DETAIL_SELECT = "id,subject,sender,toRecipients,ccRecipients,receivedDateTime,isRead,hasAttachments,body"
+
+class PostSafeRetry(Retry):
+    """
+    Retry that only repeats a POST the server turned away
+    
+    Graph can answer a POST (sendMail, $batch) with a 5xx after it has already
+    acted on it, so a POST is only retried on 429/503 carrying Retry-After.
+    """
+    
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == "POST":
+            return bool(self.total) and has_retry_after and status_code in (429, 503)
+        return super().is_retry(method, status_code, has_retry_after)
+
 class GraphSharedMailboxClient:
     def __init__(self, client_id: str, client_secret: str, tenant_id: str, shared_mailbox_email: str):
         """
@@ -35,12 +77,136 @@ class GraphSharedMailboxClient:
         self.access_token = None
         self.graph_url = "https://graph.microsoft.com/v1.0"
         
+        # Path prefix of every mailbox endpoint
+        self._user_base = f"/users/{quote(shared_mailbox_email)}"
+        
         # Required scopes - these are delegated permissions
         self.scopes = [
             "https://graph.microsoft.com/Mail.Read.Shared",
             "https://graph.microsoft.com/Mail.Send.Shared",
             "https://graph.microsoft.com/Mail.ReadWrite.Shared"
         ]
+        
+        # One keep-alive session for all Graph calls (and MSAL's token requests),
+        # retrying throttled (429) and transient server errors - POSTs only when
+        # the server turned them away
+        self._session = requests.Session()
+        retry = PostSafeRetry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "PATCH"],
+            raise_on_status=False
+        )
+        self._session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry))
+        
+        # Token cache shared by both sign-in flows and persisted across runs,
+        # so warm starts are served without a round trip to Azure AD
+        self._cache = msal.SerializableTokenCache()
+        if os.path.exists(TOKEN_CACHE_FILE):
+            with open(TOKEN_CACHE_FILE) as f:
+                self._cache.deserialize(f.read())
+        atexit.register(self._save_cache)
+        
+        # MSAL apps, built on first use of their flow (construction fetches
+        # authority metadata) and kept for later sign-ins and renewals
+        self._msal_app = None
+        self._public_app = None
+        
+        # MSAL app that issued the current token, used to renew it silently
+        self._app = None
+        self._username = None  # Account the token belongs to, so renewal stays on it
+        self._home_account_id = None
+        self._token_expiry = 0
+        self._auth_headers = {}
+        self._json_headers = {}
+        
+        # Delta links per folder, so repeated syncs only fetch changes
+        self._delta_links: Dict[str, str] = {}
+        
+        # Folder IDs by lower-cased display name, filled by the first folder listing
+        self._folder_cache: Optional[Dict[str, str]] = None
+    
+    def _save_cache(self):
+        """
+        Write the MSAL token cache back to disk if it changed
+        """
+        if not self._cache.has_state_changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(TOKEN_CACHE_FILE), exist_ok=True)
+            # Cache holds refresh tokens - keep it readable by the owner only
+            fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(self._cache.serialize())
+        except OSError as e:
+            logger.warning(f"Could not save token cache: {str(e)}")
+    
+    def _store_token(self, app, result: Dict, username: Optional[str], home_account_id: Optional[str] = None):
+        """
+        Keep a newly acquired token and note when it should be renewed
+        
+        Args:
+            app: MSAL application that issued the token
+            result (dict): MSAL token response
+            username (str): Account the token was issued to
+            home_account_id (str): MSAL id of that account, taken from the
+                ID token claims when not given
+        """
+        if home_account_id is None:
+            claims = result.get("id_token_claims", {})
+            if claims.get("oid") and claims.get("tid"):
+                home_account_id = f"{claims['oid']}.{claims['tid']}"
+        self.access_token = result["access_token"]
+        self._auth_headers = {"Authorization": f"Bearer {self.access_token}"}
+        self._json_headers = {**self._auth_headers, "Content-Type": "application/json"}
+        self._app = app
+        self._username = username
+        self._home_account_id = home_account_id
+        # Renew 5 minutes before the token expires
+        self._token_expiry = time.time() + int(result.get("expires_in", 3600)) - 300
+        self._save_cache()
+    
+    def _acquire_token_silent(self, app, username: str = None, home_account_id: str = None) -> bool:
+        """
+        Get a token from the MSAL cache, refreshing it if needed
+        
+        Args:
+            app: MSAL application to use
+            username (str): Only consider cached accounts of this user
+            home_account_id (str): Only consider the cached account with this id
+            
+        Returns:
+            bool: True if a token was obtained
+        """
+        accounts = app.get_accounts(username=username)
+        if home_account_id:
+            accounts = [a for a in accounts if a.get("home_account_id") == home_account_id]
+        if not accounts:
+            return False
+        if len(accounts) > 1:
+            # The shared cache holds several matching accounts - don't guess
+            logger.info(f"{len(accounts)} cached accounts match, not picking one silently")
+            return False
+        
+        account = accounts[0]
+        result = app.acquire_token_silent(self.scopes, account=account)
+        if result and "access_token" in result:
+            self._store_token(app, result, account.get("username"), account.get("home_account_id"))
+            return True
+        return False
+    
+    def close(self):
+        """
+        Release pooled connections
+        """
+        self._session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
     
     def authenticate(self, username: str, password: str) -> bool:
         """
@@ -55,12 +221,21 @@ class GraphSharedMailboxClient:
             bool: True if authentication successful
         """
         try:
-            # Create MSAL app
-            app = msal.ConfidentialClientApplication(
-                client_id=self.client_id,
-                client_credential=self.client_secret,
-                authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-            )
+            # Create MSAL app once
+            if self._msal_app is None:
+                self._msal_app = msal.ConfidentialClientApplication(
+                    client_id=self.client_id,
+                    client_credential=self.client_secret,
+                    authority=f"https://login.microsoftonline.com/{self.tenant_id}",
+                    token_cache=self._cache,
+                    http_client=self._session
+                )
+            app = self._msal_app
+            
+            # Try to get token from cache first
+            if self._acquire_token_silent(app, username=username):
+                logger.info("Token acquired from cache")
+                return True
             
             # Acquire token using username/password
             result = app.acquire_token_by_username_password(
@@ -70,7 +245,7 @@ class GraphSharedMailboxClient:
             )
             
             if "access_token" in result:
-                self.access_token = result["access_token"]
+                self._store_token(app, result, username)
                 logger.info("Successfully authenticated with Graph API")
                 return True
             else:
@@ -81,29 +256,34 @@ class GraphSharedMailboxClient:
             logger.error(f"Authentication error: {str(e)}")
             return False
     
-    def authenticate_interactive(self) -> bool:
+    def authenticate_interactive(self, username: str = None) -> bool:
         """
         Interactive authentication using device code flow
         This will handle consent automatically when you first authenticate
         
+        Args:
+            username (str): Account to reuse from the token cache. Without
+                it a cached token is only used when the cache holds a
+                single account
+            
         Returns:
             bool: True if authentication successful
         """
         try:
-            # Create MSAL public client app (better for interactive auth)
-            app = msal.PublicClientApplication(
-                client_id=self.client_id,
-                authority=f"https://login.microsoftonline.com/{self.tenant_id}"
-            )
+            # Create MSAL public client app once (device flow needs a public client)
+            if self._public_app is None:
+                self._public_app = msal.PublicClientApplication(
+                    client_id=self.client_id,
+                    authority=f"https://login.microsoftonline.com/{self.tenant_id}",
+                    token_cache=self._cache,
+                    http_client=self._session
+                )
+            app = self._public_app
             
             # Try to get token from cache first
-            accounts = app.get_accounts()
-            if accounts:
-                result = app.acquire_token_silent(self.scopes, account=accounts[0])
-                if result and "access_token" in result:
-                    self.access_token = result["access_token"]
-                    logger.info("Token acquired from cache")
-                    return True
+            if self._acquire_token_silent(app, username=username):
+                logger.info("Token acquired from cache")
+                return True
             
             # If no cached token, initiate device flow
             print("🔐 Starting authentication process...")
@@ -126,7 +306,7 @@ class GraphSharedMailboxClient:
             result = app.acquire_token_by_device_flow(flow)
             
             if "access_token" in result:
-                self.access_token = result["access_token"]
+                self._store_token(app, result, result.get("id_token_claims", {}).get("preferred_username"))
                 logger.info("Successfully authenticated with Graph API")
                 print("✅ Authentication successful! Consent has been granted.")
                 return True
@@ -154,23 +334,21 @@ class GraphSharedMailboxClient:
         Returns:
             str: Consent URL
         """
-        scope_param = " ".join(self.scopes)
-        consent_url = (
-            f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/authorize?"
-            f"client_id={self.client_id}&"
-            f"response_type=code&"
-            f"redirect_uri=http://localhost&"
-            f"scope={scope_param}&"
-            f"response_mode=query"
-        )
-        return consent_url
+        params = urlencode({
+            "client_id": self.client_id,
+            "response_type": "code",
+            "redirect_uri": "http://localhost",
+            "scope": " ".join(self.scopes),
+            "response_mode": "query"
+        })
+        return f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/authorize?{params}"
     
     def _make_request(self, endpoint: str, method: str = "GET", data: Dict = None) -> Optional[Dict]:
         """
         Make authenticated request to Graph API
         
         Args:
-            endpoint (str): API endpoint
+            endpoint (str): API endpoint, or an absolute URL such as an @odata.nextLink
             method (str): HTTP method
             data (dict): Request payload
             
@@ -181,25 +359,28 @@ class GraphSharedMailboxClient:
             logger.error("No access token available. Please authenticate first.")
             return None
         
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json"
-        }
+        # Renew the token silently shortly before it expires - only for the
+        # account that signed in, as the shared cache may hold others
+        if self._app is not None and time.time() >= self._token_expiry:
+            account_known = self._username or self._home_account_id
+            if not account_known or not self._acquire_token_silent(
+                    self._app, username=self._username, home_account_id=self._home_account_id):
+                logger.error("Could not renew access token silently. Please authenticate again.")
+                return None
         
-        url = f"{self.graph_url}{endpoint}"
+        url = endpoint if endpoint.startswith("https://") else f"{self.graph_url}{endpoint}"
+        
+        method = method.upper()
+        if method not in ("GET", "POST", "PATCH"):
+            raise ValueError(f"Unsupported HTTP method: {method}")
         
         try:
-            if method.upper() == "GET":
-                response = requests.get(url, headers=headers)
-            elif method.upper() == "POST":
-                response = requests.post(url, headers=headers, json=data)
-            elif method.upper() == "PATCH":
-                response = requests.patch(url, headers=headers, json=data)
+            if data is not None:
+                response = self._session.request(method, url, headers=self._json_headers, data=json_dumps(data))
             else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-            
+                response = self._session.request(method, url, headers=self._auth_headers)
             response.raise_for_status()
-            return response.json() if response.content else {}
+            return json_loads(response.content) if response.content else {}
             
         except requests.exceptions.RequestException as e:
             logger.error(f"Request failed: {str(e)}")
@@ -214,55 +395,281 @@ class GraphSharedMailboxClient:
         Returns:
             list: List of folder objects
         """
-        endpoint = f"/users/{self.shared_mailbox_email}/mailFolders"
-        result = self._make_request(endpoint)
+        result = self._make_request(self._folders_endpoint())
         
         if result and "value" in result:
             logger.info(f"Retrieved {len(result['value'])} folders from shared mailbox")
+            self._cache_folders(result["value"])
             return result["value"]
         return []
     
+    def _cache_folders(self, folders: List[Dict]):
+        """
+        Remember folder IDs by display name
+        """
+        self._folder_cache = {folder["displayName"].lower(): folder["id"] for folder in folders}
+    
+    def refresh_folders(self) -> List[Dict]:
+        """
+        Drop the cached folder IDs and list the folders again
+        
+        Returns:
+            list: List of folder objects
+        """
+        self._folder_cache = None
+        return self.get_mailbox_folders()
+    
+    def get_folder_id(self, display_name: str) -> Optional[str]:
+        """
+        Look up a folder ID by display name (case-insensitive)
+        
+        The folder list is fetched once and cached; use refresh_folders() to
+        pick up folders created since.
+        
+        Args:
+            display_name (str): Folder display name
+            
+        Returns:
+            str: Folder ID or None if there is no such folder
+        """
+        if self._folder_cache is None:
+            self.get_mailbox_folders()
+        return (self._folder_cache or {}).get(display_name.lower())
+    
+    def _resolve_folder(self, folder: str) -> str:
+        """
+        Turn a folder display name into its ID; IDs and well-known names pass through
+        """
+        if folder.lower() in WELL_KNOWN_FOLDERS:
+            return folder
+        return self.get_folder_id(folder) or folder
+    
+    def _folders_endpoint(self) -> str:
+        """
+        Build the folder list endpoint (Graph returns only 10 folders by default)
+        """
+        params = self._query([("$select", FOLDER_SELECT), ("$top", 100)])
+        return f"{self._user_base}/mailFolders?{params}"
+    
     def get_messages(self, folder_id: str = "inbox", limit: int = 10, days_back: int = 7) -> List[Dict]:
         """
         Get messages from specified folder
         
         Args:
-            folder_id (str): Folder ID or well-known name (inbox, sentitems, etc.)
+            folder_id (str): Folder ID, display name or well-known name (inbox, sentitems, etc.)
             limit (int): Maximum number of messages
             days_back (int): How many days back to search
             
         Returns:
             list: List of message objects
         """
-        # Calculate date filter
-        start_date = (datetime.now() - timedelta(days=days_back)).isoformat() + "Z"
-        
-        # Build endpoint with filter
-        endpoint = f"/users/{self.shared_mailbox_email}/mailFolders/{folder_id}/messages"
-        endpoint += f"?$filter=receivedDateTime ge {start_date}"
-        endpoint += f"&$orderby=receivedDateTime desc"
-        endpoint += f"&$top={limit}"
-        endpoint += "&$select=id,subject,sender,receivedDateTime,isRead,hasAttachments,bodyPreview"
-        
-        result = self._make_request(endpoint)
+        result = self._make_request(self._messages_endpoint(folder_id, limit, days_back))
         
         if result and "value" in result:
             logger.info(f"Retrieved {len(result['value'])} messages from {folder_id}")
             return result["value"]
         return []
     
-    def get_message_details(self, message_id: str) -> Optional[Dict]:
+    def iter_messages(self, folder_id: str = "inbox", days_back: int = 7,
+                      page_size: int = 50) -> Iterator[Dict]:
+        """
+        Iterate over all messages of a folder, newest first, one page at a time
+        
+        Pages are fetched lazily by following @odata.nextLink, so a caller that
+        stops early does not download the rest of the folder.
+        
+        Args:
+            folder_id (str): Folder ID, display name or well-known name (inbox, sentitems, etc.)
+            days_back (int): How many days back to search
+            page_size (int): Messages per page
+            
+        Yields:
+            dict: Message objects
+        """
+        endpoint = self._messages_endpoint(folder_id, page_size, days_back)
+        
+        while endpoint:
+            result = self._make_request(endpoint)
+            if not result:
+                return
+            
+            yield from result.get("value", [])
+            endpoint = result.get("@odata.nextLink")
+    
+    def iter_delta(self, folder_id: str = "inbox") -> Iterator[Dict]:
+        """
+        Iterate over the messages of a folder that changed since the last call
+        
+        The first call returns every message of the folder; later calls only
+        the ones added, changed or removed since (removed messages carry
+        an "@removed" key).
+        
+        Args:
+            folder_id (str): Folder ID, display name or well-known name (inbox, sentitems, etc.)
+            
+        Yields:
+            dict: Message objects
+        """
+        endpoint = self._delta_links.get(folder_id)
+        if endpoint is None:
+            params = self._query([("$select", MESSAGE_SELECT)])
+            endpoint = f"{self._user_base}/mailFolders/{self._resolve_folder(folder_id)}/messages/delta?{params}"
+        
+        while endpoint:
+            result = self._make_request(endpoint)
+            if not result:
+                # Expired or invalid delta link - start over on the next call
+                self._delta_links.pop(folder_id, None)
+                return
+            
+            yield from result.get("value", [])
+            endpoint = result.get("@odata.nextLink")
+            if "@odata.deltaLink" in result:
+                self._delta_links[folder_id] = result["@odata.deltaLink"]
+    
+    def _messages_endpoint(self, folder_id: str, limit: int, days_back: int) -> str:
+        """
+        Build the messages endpoint used by get_messages
+        """
+        # Calculate date filter
+        start_date = (datetime.now(timezone.utc) - timedelta(days=days_back)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        
+        # Build endpoint with filter
+        params = self._query([
+            ("$filter", f"receivedDateTime ge {start_date}"),
+            ("$orderby", "receivedDateTime desc"),
+            ("$top", limit),
+            ("$select", MESSAGE_SELECT)
+        ])
+        return f"{self._user_base}/mailFolders/{self._resolve_folder(folder_id)}/messages?{params}"
+    
+    @staticmethod
+    def _query(params: List[Tuple[str, object]]) -> str:
+        """
+        URL-encode OData query options, keeping '$' and ',' readable
+        """
+        return urlencode(params, safe="$,", quote_via=quote)
+    
+    def _batch(self, requests_list: List[Dict]) -> Dict[str, Dict]:
+        """
+        Send requests through the Graph $batch endpoint
+        
+        Requests are sent GRAPH_BATCH_LIMIT at a time. Sub-requests throttled
+        with 429 are sent again after their Retry-After delay (twice at most).
+        
+        Args:
+            requests_list (list): Request dicts with 'id', 'method', 'url'
+                (relative to the API version) and optionally 'body' and 'headers'
+            
+        Returns:
+            dict: Sub-responses keyed by request id; ids whose batch call failed are missing
+        """
+        responses = {}
+        pending = requests_list
+        
+        for attempt in range(3):
+            throttled = []
+            delay = 0
+            
+            for start in range(0, len(pending), GRAPH_BATCH_LIMIT):
+                chunk = pending[start:start + GRAPH_BATCH_LIMIT]
+                result = self._make_request("/$batch", method="POST", data={"requests": chunk})
+                if result is None:
+                    continue
+                
+                by_id = {request["id"]: request for request in chunk}
+                for item in result.get("responses", []):
+                    if item.get("status") == 429 and attempt < 2:
+                        throttled.append(by_id[item["id"]])
+                        delay = max(delay, int(item.get("headers", {}).get("Retry-After", 1)))
+                    else:
+                        responses[item["id"]] = item
+            
+            if not throttled:
+                break
+            logger.info(f"{len(throttled)} batched requests throttled, retrying in {delay}s")
+            time.sleep(delay)
+            pending = throttled
+        
+        return responses
+    
+    def get_folders_and_messages(self, folder_id: str = "inbox", limit: int = 10,
+                                 days_back: int = 7) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Get the mailbox folders and the messages of one folder in a single batched call
+        
+        Args:
+            folder_id (str): Folder ID, display name or well-known name (inbox, sentitems, etc.)
+            limit (int): Maximum number of messages
+            days_back (int): How many days back to search
+            
+        Returns:
+            tuple: (list of folder objects, list of message objects)
+        """
+        responses = self._batch([
+            {"id": "folders", "method": "GET", "url": self._folders_endpoint()},
+            {"id": "messages", "method": "GET", "url": self._messages_endpoint(folder_id, limit, days_back)}
+        ])
+        
+        lists = []
+        for request_id in ("folders", "messages"):
+            item = responses.get(request_id, {})
+            if item.get("status") == 200:
+                lists.append(item["body"].get("value", []))
+            else:
+                logger.error(f"Failed to get {request_id}: {item.get('body')}")
+                lists.append([])
+        
+        folders, messages = lists
+        if folders:
+            self._cache_folders(folders)
+        logger.info(f"Retrieved {len(folders)} folders and {len(messages)} messages from {folder_id}")
+        return folders, messages
+    
+    def get_message_details(self, message_id: str, select: Optional[str] = MESSAGE_DETAIL_SELECT) -> Optional[Dict]:
         """
         Get full details of a specific message
         
         Args:
             message_id (str): Message ID
+            select (str): Comma-separated properties to return, or None for all
             
         Returns:
             dict: Full message object
         """
-        endpoint = f"/users/{self.shared_mailbox_email}/messages/{message_id}"
-        return self._make_request(endpoint)
+        return self._make_request(self._message_endpoint(message_id, select))
+    
+    def _message_endpoint(self, message_id: str, select: Optional[str]) -> str:
+        """
+        Build the endpoint of a single message, optionally with a $select projection
+        """
+        endpoint = f"{self._user_base}/messages/{message_id}"
+        if select:
+            endpoint += "?" + self._query([("$select", select)])
+        return endpoint
+    
+    def get_message_details_bulk(self, message_ids: List[str],
+                                 select: Optional[str] = MESSAGE_DETAIL_SELECT) -> Dict[str, Optional[Dict]]:
+        """
+        Get full details of several messages with batched requests
+        
+        Args:
+            message_ids (list): Message IDs
+            select (str): Comma-separated properties to return, or None for all
+            
+        Returns:
+            dict: Full message object (None on failure) keyed by message ID
+        """
+        responses = self._batch([
+            {"id": str(i), "method": "GET", "url": self._message_endpoint(message_id, select)}
+            for i, message_id in enumerate(message_ids)
+        ])
+        
+        details = {}
+        for i, message_id in enumerate(message_ids):
+            item = responses.get(str(i), {})
+            details[message_id] = item["body"] if item.get("status") == 200 else None
+        return details
     
     def send_email(self, to_recipients: List[str], subject: str, body: str, 
                    cc_recipients: List[str] = None, body_type: str = "Text") -> bool:
@@ -279,10 +686,6 @@ class GraphSharedMailboxClient:
         Returns:
             bool: True if successful
         """
-        # Build recipient objects
-        to_list = [{"emailAddress": {"address": addr}} for addr in to_recipients]
-        cc_list = [{"emailAddress": {"address": addr}} for addr in (cc_recipients or [])]
-        
         message_data = {
             "message": {
                 "subject": subject,
@@ -290,12 +693,12 @@ class GraphSharedMailboxClient:
                     "contentType": body_type,
                     "content": body
                 },
-                "toRecipients": to_list,
-                "ccRecipients": cc_list
+                "toRecipients": self._recipients(to_recipients),
+                "ccRecipients": self._recipients(cc_recipients or [])
             }
         }
         
-        endpoint = f"/users/{self.shared_mailbox_email}/sendMail"
+        endpoint = f"{self._user_base}/sendMail"
         result = self._make_request(endpoint, method="POST", data=message_data)
         
         if result is not None:
@@ -303,22 +706,33 @@ class GraphSharedMailboxClient:
             return True
         return False
     
+    @staticmethod
+    def _recipients(addresses: List[str]) -> List[Dict]:
+        """
+        Build Graph recipient objects from email addresses
+        """
+        return [{"emailAddress": {"address": addr}} for addr in addresses]
+    
     def search_messages(self, search_term: str, folder_id: str = "inbox", limit: int = 10) -> List[Dict]:
         """
         Search for messages containing specific text
         
         Args:
             search_term (str): Text to search for
-            folder_id (str): Folder to search in
+            folder_id (str): Folder ID, display name or well-known name to search in
             limit (int): Maximum results
             
         Returns:
             list: List of matching messages
         """
-        endpoint = f"/users/{self.shared_mailbox_email}/mailFolders/{folder_id}/messages"
-        endpoint += f"?$search=\"{search_term}\""
-        endpoint += f"&$top={limit}"
-        endpoint += "&$select=id,subject,sender,receivedDateTime,isRead,hasAttachments,bodyPreview"
+        # Quote the term for $search before encoding, so spaces and '&' stay part of it
+        search_value = search_term.replace('"', '\\"')
+        params = self._query([
+            ("$search", f'"{search_value}"'),
+            ("$top", limit),
+            ("$select", MESSAGE_SELECT)
+        ])
+        endpoint = f"{self._user_base}/mailFolders/{self._resolve_folder(folder_id)}/messages?{params}"
         
         result = self._make_request(endpoint)
         
@@ -337,11 +751,33 @@ class GraphSharedMailboxClient:
         Returns:
             bool: True if successful
         """
-        endpoint = f"/users/{self.shared_mailbox_email}/messages/{message_id}"
-        data = {"isRead": True}
+        return self.mark_as_read_bulk([message_id])[message_id]
+    
+    def mark_as_read_bulk(self, message_ids: List[str]) -> Dict[str, bool]:
+        """
+        Mark several messages as read with batched requests
         
-        result = self._make_request(endpoint, method="PATCH", data=data)
-        return result is not None
+        Args:
+            message_ids (list): Message IDs
+            
+        Returns:
+            dict: True/False per message ID
+        """
+        responses = self._batch([
+            {
+                "id": str(i),
+                "method": "PATCH",
+                "url": f"{self._user_base}/messages/{message_id}",
+                "body": {"isRead": True},
+                "headers": {"Content-Type": "application/json"}
+            }
+            for i, message_id in enumerate(message_ids)
+        ])
+        
+        return {
+            message_id: responses.get(str(i), {}).get("status") == 200
+            for i, message_id in enumerate(message_ids)
+        }
     
     def display_messages(self, messages: List[Dict]):
         """
@@ -367,7 +803,7 @@ class GraphSharedMailboxClient:
                 try:
                     dt = datetime.fromisoformat(received.replace('Z', '+00:00'))
                     received = dt.strftime("%Y-%m-%d %H:%M:%S")
-                except:
+                except ValueError:
                     pass
             
             print(f"\nMessage {i}:")
@@ -420,92 +856,87 @@ def main():
     print("=" * 50)
     
     # Create client
-    client = GraphSharedMailboxClient(CLIENT_ID, CLIENT_SECRET, TENANT_ID, SHARED_MAILBOX)
-    
-    # Choose authentication method
-    print("Choose authentication method:")
-    print("1. Username/Password (ROPC)")
-    print("2. Interactive Device Code (Recommended)")
-    print("3. Generate consent URL manually")
-    
-    auth_method = input("\nEnter choice (1, 2, or 3): ").strip()
-    
-    if auth_method == "1":
-        print(f"\n🔑 Authenticating as {USERNAME}...")
-        if not client.authenticate(USERNAME, PASSWORD):
-            print("❌ Authentication failed!")
-            print("💡 Try interactive authentication (option 2) if you haven't consented yet.")
+    with GraphSharedMailboxClient(CLIENT_ID, CLIENT_SECRET, TENANT_ID, SHARED_MAILBOX) as client:
+        # Choose authentication method
+        print("Choose authentication method:")
+        print("1. Username/Password (ROPC)")
+        print("2. Interactive Device Code (Recommended)")
+        print("3. Generate consent URL manually")
+        
+        auth_method = input("\nEnter choice (1, 2, or 3): ").strip()
+        
+        if auth_method == "1":
+            print(f"\n🔑 Authenticating as {USERNAME}...")
+            if not client.authenticate(USERNAME, PASSWORD):
+                print("❌ Authentication failed!")
+                print("💡 Try interactive authentication (option 2) if you haven't consented yet.")
+                return
+        elif auth_method == "3":
+            # Generate consent URL for manual consent
+            consent_url = client.get_consent_url()
+            print(f"\n🌐 Open this URL in your browser to provide consent:")
+            print(f"\n{consent_url}\n")
+            print("📋 Steps:")
+            print("1. Copy the URL above")
+            print("2. Open it in your browser")
+            print("3. Login as bilbo@domain.com")
+            print("4. Click 'Accept' on the consent screen")
+            print("5. Come back and run the script again with option 1 or 2")
             return
-    elif auth_method == "3":
-        # Generate consent URL for manual consent
-        consent_url = client.get_consent_url()
-        print(f"\n🌐 Open this URL in your browser to provide consent:")
-        print(f"\n{consent_url}\n")
-        print("📋 Steps:")
-        print("1. Copy the URL above")
-        print("2. Open it in your browser")
-        print("3. Login as bilbo@domain.com")
-        print("4. Click 'Accept' on the consent screen")
-        print("5. Come back and run the script again with option 1 or 2")
-        return
-    else:
-        # Interactive authentication (handles consent automatically)
-        print(f"\n🔑 Starting interactive authentication for {USERNAME}...")
-        if not client.authenticate_interactive():
-            print("❌ Authentication failed!")
-            print("💡 Make sure to accept the consent screen when prompted.")
-            return
-    
-    print(f"\n✅ Successfully connected to shared mailbox: {SHARED_MAILBOX}")
-    print(f"👤 Authenticated as: bilbo")
-    
-    try:
-        # Display available folders
-        print("\n📂 Getting folder list...")
-        folders = client.get_mailbox_folders()
-        client.display_folders(folders)
-        
-        # Get recent messages from inbox
-        print("\n📧 Getting recent inbox messages...")
-        messages = client.get_messages(folder_id="inbox", limit=5, days_back=30)
-        client.display_messages(messages)
-        
-        # Search for messages
-        search_term = input("\n🔍 Enter search term (or press Enter to skip): ").strip()
-        if search_term:
-            search_results = client.search_messages(search_term, limit=3)
-            if search_results:
-                print(f"\n📋 Search results for '{search_term}':")
-                client.display_messages(search_results)
-            else:
-                print(f"No messages found matching '{search_term}'")
-        
-        # Optional: Send email
-        send_email = input("\n📤 Send test email? (y/n): ").strip().lower()
-        if send_email == 'y':
-            recipient = input("Enter recipient email: ").strip()
-            if recipient:
-                success = client.send_email(
-                    to_recipients=[recipient],
-                    subject="Test from Shared Mailbox via Graph API",
-                    body="This is a test email sent from the shared mailbox using Microsoft Graph API and Python.",
-                    body_type="Text"
-                )
-                print(f"📧 Email sent: {'✅ Success' if success else '❌ Failed'}")
-        
-    except Exception as e:
-        logger.error(f"Error during operations: {str(e)}")
-        
-        # Provide helpful error messages
-        if "Insufficient privileges" in str(e):
-            print("\n❌ Error: Insufficient privileges")
-            print("💡 Make sure:")
-            print("   - You have 'Full Access' to the shared mailbox")
-            print("   - You've provided consent for the required permissions")
-        elif "Forbidden" in str(e):
-            print("\n❌ Error: Access forbidden")
-            print("💡 This usually means consent hasn't been granted yet.")
-            print("   Try running the script again with option 3 to generate a consent URL.")
+        else:
+            # Interactive authentication (handles consent automatically)
+            print(f"\n🔑 Starting interactive authentication for {USERNAME}...")
+            if not client.authenticate_interactive(USERNAME):
+                print("❌ Authentication failed!")
+                print("💡 Make sure to accept the consent screen when prompted.")
+                return
+        
+        print(f"\n✅ Successfully connected to shared mailbox: {SHARED_MAILBOX}")
+        print(f"👤 Authenticated as: bilbo")
+        
+        try:
+            # Get the folder list and recent inbox messages in one batched call
+            print("\n📂 Getting folder list and recent inbox messages...")
+            folders, messages = client.get_folders_and_messages(folder_id="inbox", limit=5, days_back=30)
+            client.display_folders(folders)
+            client.display_messages(messages)
+            
+            # Search for messages
+            search_term = input("\n🔍 Enter search term (or press Enter to skip): ").strip()
+            if search_term:
+                search_results = client.search_messages(search_term, limit=3)
+                if search_results:
+                    print(f"\n📋 Search results for '{search_term}':")
+                    client.display_messages(search_results)
+                else:
+                    print(f"No messages found matching '{search_term}'")
+            
+            # Optional: Send email
+            send_email = input("\n📤 Send test email? (y/n): ").strip().lower()
+            if send_email == 'y':
+                recipient = input("Enter recipient email: ").strip()
+                if recipient:
+                    success = client.send_email(
+                        to_recipients=[recipient],
+                        subject="Test from Shared Mailbox via Graph API",
+                        body="This is a test email sent from the shared mailbox using Microsoft Graph API and Python.",
+                        body_type="Text"
+                    )
+                    print(f"📧 Email sent: {'✅ Success' if success else '❌ Failed'}")
+        
+        except Exception as e:
+            logger.error(f"Error during operations: {str(e)}")
+            
+            # Provide helpful error messages
+            if "Insufficient privileges" in str(e):
+                print("\n❌ Error: Insufficient privileges")
+                print("💡 Make sure:")
+                print("   - You have 'Full Access' to the shared mailbox")
+                print("   - You've provided consent for the required permissions")
+            elif "Forbidden" in str(e):
+                print("\n❌ Error: Access forbidden")
+                print("💡 This usually means consent hasn't been granted yet.")
+                print("   Try running the script again with option 3 to generate a consent URL.")
 
 
 def setup_instructions():
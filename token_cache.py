@@ -0,0 +1,5 @@
+import os
+
+# MSAL token cache shared by all the Graph scripts, kept between runs (owner-readable only).
+# It holds refresh tokens, so it lives outside the working tree.
+TOKEN_CACHE_FILE = os.getenv('TOKEN_CACHE_FILE', os.path.expanduser('~/.cache/mbxj/msal_cache.bin'))